@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Micro-benchmark for logtools.parsers.AccessLog on the combined log format.
+Compares lines/sec of AccessLog (compiled format regex) against
+a split-based tokenizer walking spaces, quoted strings and bracketed
+timestamps, hand-specialized for the combined format (i.e the best
+case for a pure-Python tokenizer).
+
+Usage: python benchmarks/bench_accesslog_parser.py [num_lines]
+"""
+import re
+import sys
+from time import time
+
+from logtools.parsers import AccessLog
+
+COMBINED_FORMAT = '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"'
+
+LINE = '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" ' \
+       '200 2326 "http://www.example.com/start.html" "Mozilla/4.08 [en] (Win98; I ;Nav)"'
+
+# Lines with escapes or non-space whitespace are left to the regex
+_needs_regex = re.compile(r'[\t\n\r\f\v\\]').search
+
+
+def tokenize_combined(line):
+    """Split a combined format line into its fields"""
+    if _needs_regex(line):
+        raise ValueError("Could not tokenize log line: '%s'" % line)
+    parts = line.split('"')
+    if len(parts) != 7 or parts[4] != ' ' or parts[6]:
+        raise ValueError("Could not tokenize log line: '%s'" % line)
+    head = parts[0].split(' ')
+    tail = parts[2].split(' ')
+    if len(head) != 6 or len(tail) != 4 or head[5] or tail[0] or tail[3]:
+        raise ValueError("Could not tokenize log line: '%s'" % line)
+    timestamp = head[3] + ' ' + head[4]
+    if timestamp[0] != '[' or timestamp[-1] != ']':
+        raise ValueError("Could not tokenize log line: '%s'" % line)
+    return (head[0], head[1], head[2], timestamp, parts[1], 
+            tail[1], tail[2], parts[3], parts[5])
+
+
+def bench(func, line, num_lines):
+    """Return lines/sec for parsing line num_lines times"""
+    t0 = time()
+    for i in xrange(num_lines):
+        func(line)
+    return num_lines / (time() - t0)
+
+
+def main():
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    parser = AccessLog(COMBINED_FORMAT)
+    projected = AccessLog(COMBINED_FORMAT, fields=['%h', '%>s'])
+    
+    assert list(tokenize_combined(LINE)) == parser(LINE).values()
+    
+    for name, func in (('AccessLog', parser), 
+                       ('AccessLog (2 fields)', projected),
+                       ('tokenizer', tokenize_combined)):
+        print "%-22s %10d lines/s" % (name, bench(func, LINE, num_lines))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Micro-benchmark for logtools.parsers.uWSGIParser.
+Compares lines/sec of the token-based uWSGI parser against
+the previously used regular expression, on matching and
+non-matching (long) lines.
+
+Usage: python benchmarks/bench_uwsgi_parser.py [num_lines]
+"""
+import re
+import sys
+from time import time
+
+from logtools.parsers import uWSGIParser
+
+# Regular expression used by uWSGIParser up to logtools 0.8.7
+UWSGI_RE = re.compile(r'.* ((?:[0-9]+\.){3}[0-9]+) .* \[(.*?)\] (GET|POST) (\S+) .* generated (\d+) bytes in (\d+) msecs .*')
+
+MATCHING = "[pid: 11216|app: 0|req: 2680/5864] 24.218.159.119 () {40 vars in 957 bytes} " \
+           "[Thu Jun 13 22:29:59 2013] GET /my/uri/path/?param_id=52&token=s61048gkje_l001z " \
+           "=> generated 1813 bytes in 11 msecs (HTTP/1.1 200) 2 headers in 73 bytes (1 switches on core 0)"
+
+# Long line which does not match (e.g a uWSGI error/traceback line)
+NON_MATCHING = "[pid: 11216|app: 0|req: 2680/5864] 24.218.159.119 () {40 vars in 957 bytes} " \
+               "[Thu Jun 13 22:29:59 2013] GET /my/uri/path/?" + "param=value&" * 100 + \
+               " => generated bytes in msecs"
+
+
+def regex_parse(line):
+    match = UWSGI_RE.match(line)
+    if not match:
+        raise ValueError("Could not parse log line: '%s'" % line)
+    return match.groups()
+
+
+def bench(func, line, num_lines):
+    """Return lines/sec for parsing line num_lines times"""
+    t0 = time()
+    for i in xrange(num_lines):
+        try:
+            func(line)
+        except ValueError:
+            pass
+    return num_lines / (time() - t0)
+
+
+def main():
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    parser = uWSGIParser()
+    
+    print "%-14s %15s %15s" % ("", "regex lines/s", "parser lines/s")
+    for name, line in (('matching', MATCHING), ('non-matching', NON_MATCHING)):
+        print "%-14s %15d %15d" % (name, bench(regex_parse, line, num_lines),
+                                   bench(parser, line, num_lines))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
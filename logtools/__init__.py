@@ -31,6 +31,7 @@ from _urlparse import *
 from _plot import *
 from _qps import *
 from _sample import *
+from _sort import *
 from _filter import *
 from _tail import *
 from _sumstat import *
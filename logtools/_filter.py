@@ -17,9 +17,10 @@ Filter rows based on blacklists and field matching.
 """
 import re
 import sys
+import sre_parse
+import sre_constants
 import string
 import logging
-from itertools import imap
 from functools import partial
 from operator import and_
 from optparse import OptionParser
@@ -27,7 +28,12 @@ from optparse import OptionParser
 import acora
 
 from _config import logtools_config, interpolate_config, AttrDict
+from logtools.readers import open_inputs
+from logtools.utils import trie_regex, is_mergeable_pattern
 import logtools.parsers
+from logtools.detect import detect_stream_parser
+from logtools.parallel import filter_lines, parallel_filter_lines, is_regular_file
+from logtools.blacklists import cached_compile, WatchedBlacklist
 
 __all__ = ['logfilter_parse_args', 'logfilter', 
            'logfilter_main']
@@ -42,22 +48,158 @@ _word_boundary_chars = set(string.printable)\
                      .difference(('_',))
 
 
-def _is_blacklisted_re_wb(line, delimiter, field, blacklist, re_flags):
-    val = line.split(delimiter)[field-1]
-    for b in blacklist:
-        if re.search(r'\b{0}\b'.format(b), val, re_flags):
+# Regular expression metacharacters. Blacklist entries
+# not containing any of these are matched as literal strings.
+_re_special_chars = frozenset('.^$*+?{}[]\\|()')
+
+
+def _compile_blacklist_re(blacklist, re_flags=0, word_boundaries=False):
+    """Compile blacklist entries into a list of regular expressions.
+    Normally this is a single alternation, with literal entries factored
+    into a trie so that shared prefixes are only matched once. Falls back
+    to one expression per entry if the alternation can't be compiled
+    (e.g too many groups). Entries with backreferences or inline flags
+    are compiled separately (see is_mergeable_pattern). With word_boundaries,
+    each entry as a whole must match on word boundaries, e.g 'foo|bar'
+    matches as r'\b(?:foo|bar)\b' rather than r'\bfoo|bar\b'"""
+    if not blacklist:
+        return []
+    
+    wrapper = word_boundaries and r'\b(?:%s)\b' or r'(?:%s)'
+    literals = [b for b in blacklist if not _re_special_chars.intersection(b)]
+    patterns = [b for b in blacklist if _re_special_chars.intersection(b)]
+    separate = [b for b in patterns if not is_mergeable_pattern(b, re_flags)]
+    if separate:
+        patterns = [b for b in patterns if b not in separate]
+    try:
+        separate = [re.compile(wrapper % b, re_flags) for b in separate]
+        alternatives = ['(?:%s)' % p for p in patterns]
+        if literals:
+            alternatives.insert(0, trie_regex(literals))
+        if not alternatives:
+            return separate
+        return [re.compile(wrapper % '|'.join(alternatives), re_flags)] + separate
+    except (re.error, AssertionError, OverflowError, RuntimeError), exc:
+        logging.warn("Could not compile blacklist into a single "
+                     "regular expression, matching entries one by one: %s", exc)
+        return [re.compile(wrapper % b, re_flags) for b in blacklist]
+
+def _field_value(line, delimiter, field):
+    """Return given (1-based) field of line. If field is None,
+    line is the value itself (e.g a parsed field)"""
+    if field is None:
+        return line
+    return line.split(delimiter)[field-1]
+
+def _is_blacklisted_re(line, delimiter, field, regexes):
+    val = _field_value(line, delimiter, field)
+    for regex in regexes:
+        if regex.search(val):
             return True
-    return False    
+    return False            
+
+def _literal_runs(subpattern):
+    """Yield runs of consecutive literal characters
+    in a parsed regular expression (sequence)"""
+    run = []
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL:
+            run.append(av < 256 and chr(av) or unichr(av))
+        elif op == sre_constants.SUBPATTERN:
+            # Group contents are matched in sequence, so its first
+            # and last runs join with the surrounding literals
+            sub_runs = list(_literal_runs(av[1]))
+            run.extend(sub_runs[0])
+            if len(sub_runs) > 1:
+                yield ''.join(run)
+                for sub_run in sub_runs[1:-1]:
+                    yield sub_run
+                run = list(sub_runs[-1])
+        else:
+            yield ''.join(run)
+            run = []
+    yield ''.join(run)
 
-def _is_blacklisted_re(line, delimiter, field, blacklist, re_flags):
-    val = line.split(delimiter)[field-1]
+def _required_literal(pattern, re_flags=0):
+    """Return the longest literal substring that any match of
+    given regular expression must contain, or None if there isn't one.
+    Literal is lower-cased for case-insensitive expressions"""
+    try:
+        parsed = sre_parse.parse(pattern, re_flags)
+    except (sre_constants.error, OverflowError, RuntimeError):
+        return None
+    literal = max(_literal_runs(parsed), key=len)
+    if not literal:
+        return None
+    if parsed.pattern.flags & re.IGNORECASE:
+        if not re_flags & re.IGNORECASE:
+            # Inline (?i) flag, values are not lower-cased for matching
+            return None
+        literal = literal.lower()
+    return literal
+
+class _LiteralRegexes(dict):
+    """Maps required literals to the compiled regular expressions
+    of the blacklist entries containing them. Expressions are
+    compiled on first use, as most literals typically never hit"""
+    def __init__(self, by_literal, re_flags=0, word_boundaries=False):
+        dict.__init__(self)
+        self.by_literal = by_literal
+        self.re_flags = re_flags
+        self.word_boundaries = word_boundaries
+        
+    def __missing__(self, literal):
+        regexes = self[literal] = _compile_blacklist_re(self.by_literal[literal], 
+                        re_flags=self.re_flags, word_boundaries=self.word_boundaries)
+        return regexes
+
+def _group_by_literal(blacklist, re_flags=0):
+    """Group blacklist entries by their required literal.
+    Returns (literal -> entries map, entries without a required literal)"""
+    by_literal = {}
+    no_literal = []
     for b in blacklist:
-        if re.search(r'{0}'.format(b), val, re_flags):
+        literal = _required_literal(b, re_flags)
+        if literal is None:
+            no_literal.append(b)
+        else:
+            by_literal.setdefault(literal, []).append(b)
+    return by_literal, no_literal
+
+def _compile_blacklist_prefilter(by_literal, no_literal, re_flags=0, word_boundaries=False):
+    """Build an Aho-Corasick automaton over the required literals
+    of blacklist entries (see _group_by_literal), so that an entry's 
+    regular expression only needs to run on values containing its literal.
+    Returns (automaton, literal -> regexes map, regexes for entries 
+    without a required literal), or None if no entry has a literal"""
+    if not by_literal:
+        return None
+    
+    ac = acora.AcoraBuilder(*by_literal.keys()).build()
+    literal_regexes = _LiteralRegexes(by_literal, re_flags=re_flags, 
+                                      word_boundaries=word_boundaries)
+    regexes = _compile_blacklist_re(no_literal, re_flags=re_flags, 
+                                    word_boundaries=word_boundaries)
+    return ac, literal_regexes, regexes
+
+def _is_blacklisted_re_prefilter(line, delimiter, field, transform_func, 
+                                 ac, literal_regexes, regexes):
+    val = _field_value(line, delimiter, field)
+    for regex in regexes:
+        if regex.search(val):
             return True
-    return False            
+    checked = set()
+    for literal, pos in ac.finditer(transform_func(val)):
+        if literal in checked:
+            continue
+        checked.add(literal)
+        for regex in literal_regexes[literal]:
+            if regex.search(val):
+                return True
+    return False
 
 def _is_blacklisted_ac_wb(line, delimiter, field, transform_func, ac):
-    val = line.split(delimiter)[field-1]
+    val = _field_value(line, delimiter, field)
     L = len(val)
     matches = ac.findall(transform_func(val))
     for match in matches:
@@ -69,7 +211,7 @@ def _is_blacklisted_ac_wb(line, delimiter, field, transform_func, ac):
     return False
 
 def _is_blacklisted_ac(line, delimiter, field, transform_func, ac):
-    val = line.split(delimiter)[field-1]
+    val = _field_value(line, delimiter, field)
     matches = ac.findall(transform_func(val))
     if matches:
         return True
@@ -98,12 +240,19 @@ def logfilter_parse_args():
                       help="Print non-filtered lines")    
     parser.add_option("--parser", dest="parser",
                       help="Feed logs through a parser. Useful when reading encoded/escaped formats (e.g JSON) and when " \
-                      "selecting parsed fields rather than matching via regular expression.")
+                      "selecting parsed fields rather than matching via regular expression. " \
+                      "Use 'auto' to detect the log format from the input.")
     parser.add_option("-d", "--delimiter", dest="delimiter",
                       help="Delimiter character for field-separation (when not using a --parser)")        
     parser.add_option("-f", "--field", dest="field",
                       help="Index of field to use for filtering against")
 
+    parser.add_option("-j", "--jobs", dest="jobs", type=int, default=None,
+                      help="Number of worker processes to filter with, when input is a regular file")
+    parser.add_option("-C", "--cache", dest="cache", action="store_true",
+                      help="Cache compiled blacklists on disk (under ~/.cache/logtools), keyed by their contents")
+    parser.add_option("--watch", dest="watch", action="store_true",
+                      help="Watch blacklist file for changes, and reload it while running")
     parser.add_option("-P", "--profile", dest="profile", default='logfilter',
                       help="Configuration profile (section in configuration file)")
 
@@ -126,62 +275,107 @@ def logfilter_parse_args():
                         options.profile, 'with_acora', default=False, type=bool)    
     options.printlines = interpolate_config(options.printlines, 
                         options.profile, 'print', default=False, type=bool)     
+    options.cache = interpolate_config(options.cache, 
+                                       options.profile, 'cache', default=False, type=bool)
+    options.watch = interpolate_config(options.watch, 
+                                       options.profile, 'watch', default=False, type=bool)
+    options.jobs = interpolate_config(options.jobs, options.profile, 'jobs', 
+                                      default=1, type=int)
     
     if options.parser and not options.field:
         parser.error("Must supply --field parameter when using parser-based matching.")
 
     return AttrDict(options.__dict__), args
 
-def logfilter(fh, blacklist, field, parser=None, reverse=False, 
-              delimiter=None, ignorecase=False, with_acora=False, 
-              word_boundaries=False, **kwargs):
-    """Filter rows from a log stream using a blacklist"""
-    
+def _compile_blacklist_func(blacklist, field, delimiter=None, ignorecase=False, 
+                            with_acora=False, word_boundaries=False, cache=False):
+    """Compile blacklist (file) into a predicate function,
+    checking whether given field of a line is blacklisted"""
     blacklist = dict.fromkeys([l.strip() for l \
                                in blacklist \
                                if l and not l.startswith('#')])
     re_flags = 0
     
+    _transform_func = lambda x: x
     if ignorecase:
         re_flags = re.IGNORECASE
+        _transform_func = lambda x: x.lower()
         
     _is_blacklisted=None
     if with_acora is False:
-        # Regular expression based matching
-        if word_boundaries:
-            _is_blacklisted = partial(_is_blacklisted_re_wb, 
-                delimiter=delimiter, field=field, blacklist=blacklist, re_flags=re_flags)
+        # Regular expression based matching. Expressions are 
+        # prefiltered using an Aho-Corasick automaton over their
+        # required literal substrings where possible.
+        if cache:
+            by_literal, no_literal = cached_compile('logfilter', sorted(blacklist), 
+                partial(_group_by_literal, re_flags=re_flags), 
+                options={'ignorecase': ignorecase, 'word_boundaries': word_boundaries})
         else:
+            by_literal, no_literal = _group_by_literal(blacklist, re_flags=re_flags)
+        prefilter = _compile_blacklist_prefilter(by_literal, no_literal, re_flags=re_flags, 
+                                                 word_boundaries=word_boundaries)
+        if prefilter:
+            ac, literal_regexes, regexes = prefilter
+            _is_blacklisted = partial(_is_blacklisted_re_prefilter, 
+                delimiter=delimiter, field=field, transform_func=_transform_func, 
+                ac=ac, literal_regexes=literal_regexes, regexes=regexes)
+        else:
+            regexes = _compile_blacklist_re(blacklist, re_flags=re_flags, 
+                                            word_boundaries=word_boundaries)
             _is_blacklisted = partial(_is_blacklisted_re, 
-                delimiter=delimiter, field=field, blacklist=blacklist, re_flags=re_flags)                        
+                delimiter=delimiter, field=field, regexes=regexes)
     else:
         # Aho-Corasick multiple string pattern matching
         # using the acora Cython library
         builder = acora.AcoraBuilder(*blacklist)
         ac = builder.build()
-        _transform_func = lambda x: x
-        if ignorecase:
-            _transform_func = lambda x: x.lower()
         
         if word_boundaries:
             _is_blacklisted = partial(_is_blacklisted_ac_wb, 
                 delimiter=delimiter, field=field, transform_func=_transform_func, ac=ac)
         else:
             _is_blacklisted = partial(_is_blacklisted_ac, 
-                delimiter=delimiter, field=field, transform_func=_transform_func, ac=ac)                        
+                delimiter=delimiter, field=field, transform_func=_transform_func, ac=ac)
+
+    return _is_blacklisted
+
+def logfilter(fh, blacklist, field, parser=None, reverse=False, 
+              delimiter=None, ignorecase=False, with_acora=False, 
+              word_boundaries=False, jobs=1, cache=False, watch=False, **kwargs):
+    """Filter rows from a log stream using a blacklist. field is a
+    (1-based) field index, or with a parser, comma-separated 
+    field names or indices of the parsed fields to match"""
+    
+    # With a parser, the blacklist is matched against parsed field values
+    compile_func = partial(_compile_blacklist_func, 
+                           field=None if parser else int(field), delimiter=delimiter, 
+                           ignorecase=ignorecase, with_acora=with_acora, 
+                           word_boundaries=word_boundaries, cache=cache)
+    if watch and hasattr(blacklist, 'name'):
+        # Rebuild matcher in the background when blacklist file changes
+        _is_blacklisted = WatchedBlacklist(blacklist, compile_func)
+    else:
+        _is_blacklisted = compile_func(blacklist)
                 
     _is_blacklisted_func = _is_blacklisted
     if parser:
         # Custom parser specified, use field-based matching
-        parser = eval(parser, vars(logtools.parsers), {})()
+        if parser == 'auto':
+            parser, fh = detect_stream_parser(fh)
+        else:
+            parser = logtools.parsers.get_parser(parser)
         fields = field.split(',')
         is_indices = reduce(and_, (k.isdigit() for k in fields), True)
+        if not is_indices:
+            # Only extract the fields used for filtering
+            parser.set_fields(fields)
         if is_indices:
             # Field index based matching
+            indices = [int(k)-1 for k in fields]
             def _is_blacklisted_func(line):
                 parsed_line = parser(line)
-                for field in fields:
-                    if _is_blacklisted(parsed_line.by_index(field)):
+                for index in indices:
+                    if _is_blacklisted(parsed_line.by_index(index, raw=True)):
                         return True
                 return False
         else:
@@ -189,34 +383,26 @@ def logfilter(fh, blacklist, field, parser=None, reverse=False,
             def _is_blacklisted_func(line):
                 parsed_line = parser(line)
                 for field in fields:
-                    if _is_blacklisted(parsed_line.by_index(field)):
+                    if _is_blacklisted(parsed_line[field]):
                         return True
                 return False            
             
-    num_lines=0
-    num_filtered=0
-    num_nomatch=0
-    for line in imap(lambda x: x.strip(), fh):
-        try:
-            is_blacklisted = _is_blacklisted_func(line)
-        except (KeyError, ValueError):
-            # Parsing error
-            logging.warn("No match for line: %s", line)
-            num_nomatch +=1
-            continue
-        else:
-            if is_blacklisted ^ reverse:
-                logging.debug("Filtering line: %s", line)
-                num_filtered+=1
-                continue
+    counts = {}
+    if jobs > 1 and is_regular_file(fh):
+        lines = parallel_filter_lines(fh, _is_blacklisted_func, reverse=reverse, 
+                                      counts=counts, jobs=jobs)
+    else:
+        lines = filter_lines(fh, _is_blacklisted_func, reverse=reverse, counts=counts)
+    for line in lines:
+        yield line
 
-            num_lines+=1
-            yield line
+    if isinstance(_is_blacklisted, WatchedBlacklist):
+        _is_blacklisted.stop()
 
-    logging.info("Number of lines after filtering: %s", num_lines)
-    logging.info("Number of lines filtered: %s", num_filtered)        
-    if num_nomatch:
-        logging.info("Number of lines could not match on: %s", num_nomatch)
+    logging.info("Number of lines after filtering: %s", counts['lines'])
+    logging.info("Number of lines filtered: %s", counts['filtered'])        
+    if counts['nomatch']:
+        logging.info("Number of lines could not match on: %s", counts['nomatch'])
 
     return
 
@@ -224,10 +410,10 @@ def logfilter_main():
     """Console entry-point"""
     options, args = logfilter_parse_args()
     if options.printlines:
-        for line in logfilter(fh=sys.stdin, *args, **options):
+        for line in logfilter(fh=open_inputs(args), **options):
             print line
     else:
-        for line in logfilter(fh=sys.stdin, *args, **options): 
+        for line in logfilter(fh=open_inputs(args), **options): 
             pass
 
     return 0
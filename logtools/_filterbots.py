@@ -17,17 +17,27 @@ Filter bots from logrows based on an ip/host and useragent blacklists.
 """
 import re
 import sys
+import time
 import logging
+from calendar import timegm
 from itertools import imap
 from functools import partial
 from operator import and_
 from optparse import OptionParser
 
 from _config import logtools_config, interpolate_config, AttrDict
+from logtools.readers import open_inputs
+from logtools.utils import trie_regex, is_mergeable_pattern, ClockCache
 import logtools.parsers
+from logtools.detect import detect_stream_parser
+from logtools.behavior import BehaviorDetector
+from logtools.timestamps import clf_epoch, get_timestamp_parser
+from logtools.parallel import filter_lines, parallel_filter_lines, is_regular_file
+from logtools.blacklists import HashedSet, is_hashed_set, open_hashed_set, \
+     cached_compile, WatchedBlacklist, IPRangeSet, read_blacklist
 
 __all__ = ['filterbots_parse_args', 'filterbots', 
-           'filterbots_main', 'parse_bots_ua', 'is_bot_ua']
+           'filterbots_main', 'parse_bots_ua', 'is_bot_ua', 'compile_bots_ua']
 
 def filterbots_parse_args():
     usage = "%prog " \
@@ -39,23 +49,55 @@ def filterbots_parse_args():
     parser.add_option("-u", "--bots-ua", dest="bots_ua", default=None, 
                       help="Bots useragents blacklist file")
     parser.add_option("-i", "--bots-ips", dest="bots_ips", default=None, 
-                      help="Bots ips blacklist file")
+                      help="Bots ips blacklist file. IPv4/IPv6 addresses or CIDR blocks (e.g 10.0.0.0/8), one per line")
+    parser.add_option("--bots-ips-index", dest="bots_ips_index", default=None, 
+                      help="Memory-mapped hashed index file for the bots ips blacklist. " \
+                      "Built from the blacklist file when missing or outdated. Suitable for very large blacklists " \
+                      "of single addresses (CIDR blocks are not supported)")
     parser.add_option("-r", "--ip-ua-re", dest="ip_ua_re", default=None, 
                       help="Regular expression to match IP/useragent fields." \
-                      "Should have an 'ip' and 'ua' named groups")
+                      "Should have an 'ip' and 'ua' named groups. For pattern analysis (--pattern), " \
+                      "optional 'ts' (timestamp) and 'path' named groups are used as well")
     parser.add_option("-p", "--print", dest="printlines", action="store_true",
                       help="Print non-filtered lines")
     parser.add_option("-t", "--pattern", dest="pattern", action="store_true",
-                      help="Use pattern analysis to filter bots (See documentation for details)")    
+                      help="Use pattern analysis to filter bots: Clients (ip/useragent) exceeding a request rate or " \
+                      "number of distinct paths within a sliding window, or issuing requests at suspiciously " \
+                      "regular intervals, are flagged as bots while the stream is processed")    
+    parser.add_option("--pattern-window", dest="pattern_window", type=float, default=None,
+                      help="Sliding window size in seconds, for pattern analysis (default: 60)")
+    parser.add_option("--pattern-max-requests", dest="pattern_max_requests", type=int, default=None,
+                      help="Maximum requests per client within window, for pattern analysis (default: 120)")
+    parser.add_option("--pattern-max-paths", dest="pattern_max_paths", type=int, default=None,
+                      help="Maximum distinct paths per client within window, for pattern analysis (default: 100)")
+    parser.add_option("--pattern-max-clients", dest="pattern_max_clients", type=int, default=None,
+                      help="Maximum number of clients tracked by pattern analysis, bounding its memory use (default: 100000)")
+    parser.add_option("--pattern-blacklist", dest="pattern_blacklist", default=None,
+                      help="Blacklist file to which IPs of clients flagged by pattern analysis are appended, " \
+                      "as they are flagged. E.g the bots IPs blacklist, which is reloaded while running with --watch")
+    parser.add_option("--date-format", dest="date_format", default=None,
+                      help="Date format of the timestamp ('ts') field, for pattern analysis. " \
+                      "By default, epoch seconds and CLF timestamps are recognized. Without a timestamp field, " \
+                      "arrival time is used")
     parser.add_option("-R", "--reverse", dest="reverse", action="store_true",
                       help="Reverse filtering")
     parser.add_option("--parser", dest="parser",
                       help="Feed logs through a parser. Useful when reading encoded/escaped formats (e.g JSON) and when " \
-                      "selecting parsed fields rather than matching via regular expression.")
+                      "selecting parsed fields rather than matching via regular expression. " \
+                      "Use 'auto' to detect the log format from the input.")
     parser.add_option("-f", "--ip-ua-fields", dest="ip_ua_fields",
                       help="Field(s) Selector for filtering bots when using a parser (--parser). Format should be " \
-                      " 'ua:<ua_field_name>,ip:<ip_field_name>'. If one of these is missing, it will not be used for filtering.")
+                      " 'ua:<ua_field_name>,ip:<ip_field_name>'. If one of these is missing, it will not be used for filtering. " \
+                      "For pattern analysis (--pattern), 'ts:<timestamp_field_name>' and 'path:<path_field_name>' may be given as well.")
 
+    parser.add_option("-j", "--jobs", dest="jobs", type=int, default=None,
+                      help="Number of worker processes to filter with, when input is a regular file")
+    parser.add_option("-C", "--cache", dest="cache", action="store_true",
+                      help="Cache compiled blacklists on disk (under ~/.cache/logtools), keyed by their contents")
+    parser.add_option("--watch", dest="watch", action="store_true",
+                      help="Watch blacklist files for changes, and reload them while running")
+    parser.add_option("--verdict-cache-size", dest="verdict_cache_size", type=int, default=None,
+                      help="Number of useragent/IP verdicts to cache (default: 10000, 0 to disable)")
     parser.add_option("-P", "--profile", dest="profile", default='filterbots',
                       help="Configuration profile (section in configuration file)")
 
@@ -66,6 +108,8 @@ def filterbots_parse_args():
                                                options.profile, 'bots_ua'), "r")
     options.bots_ips = open(interpolate_config(options.bots_ips, 
                                                options.profile, 'bots_ips'), "r")
+    options.bots_ips_index = interpolate_config(options.bots_ips_index, 
+                                                options.profile, 'bots_ips_index', default=False)
     options.ip_ua_re = interpolate_config(options.ip_ua_re, 
                                            options.profile, 'ip_ua_re', default=False)  
     options.parser = interpolate_config(options.parser, options.profile, 'parser', 
@@ -76,10 +120,33 @@ def filterbots_parse_args():
                                        default=False)      
     options.pattern = interpolate_config(options.pattern, 
                                            options.profile, 'pattern', default=False, type=bool)    
+    options.pattern_window = interpolate_config(options.pattern_window, options.profile, 
+                                                'pattern_window', default=60, type=float)
+    options.pattern_max_requests = interpolate_config(options.pattern_max_requests, options.profile, 
+                                                      'pattern_max_requests', default=120, type=int)
+    options.pattern_max_paths = interpolate_config(options.pattern_max_paths, options.profile, 
+                                                   'pattern_max_paths', default=100, type=int)
+    options.pattern_max_clients = interpolate_config(options.pattern_max_clients, options.profile, 
+                                                     'pattern_max_clients', default=100000, type=int)
+    options.pattern_blacklist = interpolate_config(options.pattern_blacklist, options.profile, 
+                                                   'pattern_blacklist', default=False)
+    if options.pattern_blacklist:
+        options.pattern_blacklist = open(options.pattern_blacklist, "a")
+    options.date_format = interpolate_config(options.date_format, options.profile, 
+                                             'date_format', default=False)
     options.reverse = interpolate_config(options.reverse, 
                                            options.profile, 'reverse', default=False, type=bool)
     options.printlines = interpolate_config(options.printlines, 
                                              options.profile, 'print', default=False, type=bool) 
+    options.cache = interpolate_config(options.cache, 
+                                       options.profile, 'cache', default=False, type=bool)
+    options.watch = interpolate_config(options.watch, 
+                                       options.profile, 'watch', default=False, type=bool)
+    if options.verdict_cache_size is None:
+        options.verdict_cache_size = interpolate_config(None, options.profile, 'verdict_cache_size', 
+                                                        default=10000, type=int)
+    options.jobs = interpolate_config(options.jobs, options.profile, 'jobs', 
+                                      default=1, type=int)
     
     if options.parser and not options.ip_ua_fields:
         parser.error("Must supply --ip-ua-fields parameter when using parser-based matching.")
@@ -140,19 +207,169 @@ def is_bot_ua(useragent, bots_ua_dict, bots_ua_prefix_dict, bots_ua_suffix_dict,
                         return True
     return False
 
+def _compile_alternation(regexes):
+    """Merge compiled regular expressions into a single alternation.
+    Expressions with flags (e.g inline (?i)) or backreferences are kept
+    separate (see is_mergeable_pattern). Returns list of compiled expressions"""
+    default_flags = re.compile('').flags
+    mergeable = [r.flags == default_flags and is_mergeable_pattern(r.pattern) for r in regexes]
+    patterns = [r.pattern for r, m in zip(regexes, mergeable) if m]
+    separate = [r for r, m in zip(regexes, mergeable) if not m]
+    if len(patterns) < 2:
+        return list(regexes)
+    try:
+        merged = re.compile('|'.join(['(?:%s)' % p for p in patterns]))
+    except (re.error, AssertionError, OverflowError, RuntimeError), exc:
+        # E.g too many groups
+        logging.debug("Could not merge bots useragent regular expressions: %s", exc)
+        return list(regexes)
+    return [merged] + separate
+
+def compile_bots_ua(bots_ua_dict, bots_ua_prefix_dict, bots_ua_suffix_dict, bots_ua_re):
+    """Compile parsed bots useragents blacklist (see parse_bots_ua) into
+    a useragent predicate. Prefixes and suffixes are factored into tries
+    matched by a single (anchored) regular expression each, suffixes being
+    matched over the reversed useragent, so that each check is linear in the
+    useragent length rather than in the blacklist size. Same result as is_bot_ua"""
+    prefix_match = suffix_match = None
+    if bots_ua_prefix_dict:
+        prefix_match = re.compile(trie_regex(bots_ua_prefix_dict)).match
+    if bots_ua_suffix_dict:
+        suffix_match = re.compile(trie_regex([s[::-1] for s in bots_ua_suffix_dict])).match
+    regex_matches = [r.match for r in _compile_alternation(bots_ua_re)]
+    
+    def _is_bot_ua(useragent):
+        if not useragent:
+            return False
+        if useragent in bots_ua_dict:
+            return True
+        if prefix_match and prefix_match(useragent):
+            return True
+        if suffix_match and suffix_match(useragent[::-1]):
+            return True
+        for regex_match in regex_matches:
+            if regex_match(useragent):
+                return True
+        return False
+    return _is_bot_ua
+
+def _compile_bots_ua(bots_ua, cache=False):
+    """Compile bots useragents blacklist (file)
+    into a useragent predicate function"""
+    if cache:
+        bots_ua = cached_compile('bots_ua', bots_ua, parse_bots_ua)
+    else:
+        bots_ua = parse_bots_ua(bots_ua)
+    return compile_bots_ua(*bots_ua)
+
+def _compile_bots_ips(bots_ips, bots_ips_index=None):
+    """Load bots ips blacklist (file) into a container"""
+    bots_ips_name = getattr(bots_ips, 'name', None)
+    if bots_ips_index:
+        # Memory-mapped hashed set, (re)built from blacklist if outdated
+        return open_hashed_set(bots_ips_index, source=bots_ips_name)
+    elif bots_ips_name and is_hashed_set(bots_ips_name):
+        return HashedSet(bots_ips_name)
+    return IPRangeSet(read_blacklist(bots_ips))
+
+def _timestamp_decoder(date_format=None):
+    """Return function decoding timestamp field values into epoch 
+    seconds, using given date format, or recognizing epoch seconds
+    and CLF timestamps. Missing values are replaced by current time"""
+    parse_dt = date_format and get_timestamp_parser(date_format)
+    
+    def _decode(value):
+        if not value:
+            return time.time()
+        if parse_dt:
+            return timegm(parse_dt(value).timetuple())
+        try:
+            return float(value)
+        except ValueError:
+            if not value.startswith('['):
+                value = '[%s]' % value
+            return clf_epoch(value)
+    return _decode
+
 def filterbots(fh, ip_ua_re, bots_ua, bots_ips, 
                parser=None, format=None, ip_ua_fields=None, 
-               reverse=False, debug=False, **kwargs):
+               reverse=False, debug=False, jobs=1, bots_ips_index=None, 
+               cache=False, watch=False, verdict_cache_size=10000, 
+               pattern=False, pattern_window=60, pattern_max_requests=120,
+               pattern_max_paths=100, pattern_max_clients=100000, 
+               pattern_blacklist=None, date_format=None, **kwargs):
     """Filter bots from a log stream using
-    ip/useragent blacklists"""
-    bots_ua_dict, bots_ua_prefix_dict, bots_ua_suffix_dict, bots_ua_re = \
-                parse_bots_ua(bots_ua)
-    bots_ips = dict.fromkeys([l.strip() for l in bots_ips \
-                              if not l.startswith("#")])
-    is_bot_ua_func = partial(is_bot_ua, bots_ua_dict=bots_ua_dict, 
-                         bots_ua_prefix_dict=bots_ua_prefix_dict, 
-                         bots_ua_suffix_dict=bots_ua_suffix_dict, 
-                         bots_ua_re=bots_ua_re)    
+    ip/useragent blacklists, and optionally 
+    behavioral pattern analysis. IPs of clients flagged by
+    pattern analysis are appended to pattern_blacklist 
+    (file object), if given"""
+    compile_bots_ua = partial(_compile_bots_ua, cache=cache)
+    compile_bots_ips = partial(_compile_bots_ips, bots_ips_index=bots_ips_index)
+    watchers = {}
+    if watch and hasattr(bots_ua, 'name'):
+        # Rebuild matchers in the background when blacklist files change
+        is_bot_ua_func = watchers['ua'] = WatchedBlacklist(bots_ua, compile_bots_ua)
+    else:
+        is_bot_ua_func = compile_bots_ua(bots_ua)
+    if watch and hasattr(bots_ips, 'name'):
+        bots_ips = watchers['ip'] = WatchedBlacklist(bots_ips, compile_bots_ips)
+    else:
+        bots_ips = compile_bots_ips(bots_ips)
+    is_bot_ip_func = bots_ips.__contains__
+    
+    caches = {}
+    if verdict_cache_size:
+        # Useragents/IPs are highly repetitive, cache the verdicts
+        is_bot_ua_func = caches['ua'] = ClockCache(is_bot_ua_func, maxsize=verdict_cache_size)
+        is_bot_ip_func = caches['ip'] = ClockCache(is_bot_ip_func, maxsize=verdict_cache_size)
+        for key, watcher in watchers.iteritems():
+            # Cached verdicts are stale once blacklist is reloaded
+            watcher.on_reload = caches[key].clear
+            
+    def _cache_stats():
+        stats = {}
+        for key, cache in caches.iteritems():
+            stats[key + '_hits'] = cache.hits
+            stats[key + '_misses'] = cache.misses
+        return stats
+    
+    detector = None
+    pattern_counts = {'bad_ts': 0}
+    if pattern:
+        on_flag = None
+        if pattern_blacklist:
+            def _write_ip(ip):
+                pattern_blacklist.write("%s\n" % ip)
+                pattern_blacklist.flush()
+            # Each IP is written once (IPs of most flagged clients are remembered)
+            _write_ip = ClockCache(_write_ip, maxsize=pattern_max_clients)
+            def on_flag(key, reason):
+                ip = key[0]
+                if ip:
+                    _write_ip(ip)
+                
+        detector = BehaviorDetector(window=pattern_window, max_requests=pattern_max_requests,
+                                    max_paths=pattern_max_paths, max_clients=pattern_max_clients,
+                                    on_flag=on_flag)
+        decode_ts = _timestamp_decoder(date_format)
+        if jobs > 1:
+            # Detector state must see the whole stream, in order
+            logging.info("Pattern analysis enabled, filtering using a single process")
+            jobs = 1
+        
+    def _is_bot(ua=None, ip=None, ts=None, path=None):
+        if is_bot_ua_func(ua) or is_bot_ip_func(ip):
+            return True
+        if detector is not None:
+            try:
+                ts = decode_ts(ts)
+            except ValueError:
+                # Line is not a bot as far as blacklists are concerned
+                logging.warn("Could not decode timestamp, skipping pattern analysis: %s", ts)
+                pattern_counts['bad_ts'] += 1
+                return False
+            return detector((ip, ua), ts, path)
+        return False
     
     _is_bot_func=None    
     if not parser:
@@ -166,70 +383,70 @@ def filterbots(fh, ip_ua_re, bots_ua, bots_ips,
             logging.debug("Regular expression matched line: %s", match)
     
             matchgroups = match.groupdict()
-            is_bot = False
-    
-            ua = matchgroups.get('ua', None)
-            is_bot = is_bot_ua_func(ua)        
-    
-            if not is_bot and matchgroups.get('ip', None) in bots_ips:
-                # IP Is blacklisted
-                is_bot = True
-                
-            return is_bot
+            return _is_bot(matchgroups.get('ua', None), matchgroups.get('ip', None),
+                           matchgroups.get('ts', None), matchgroups.get('path', None))
                 
     else:
         # Custom parser specified, use field-based matching
-        parser = eval(parser, vars(logtools.parsers), {})()
+        if parser == 'auto':
+            parser, fh = detect_stream_parser(fh)
+        else:
+            parser = logtools.parsers.get_parser(parser)
         try:
             fields_map = dict([tuple(k.split(':')) for k in ip_ua_fields.split(',')])
         except ValueError:
             raise ValueError("Invalid format for --field parameter. Use --help for usage instructions.")
         is_indices = reduce(and_, (k.isdigit() for k in fields_map.values()), True)
+        fields = [(key, fields_map[key]) for key in ('ua', 'ip', 'ts', 'path') if key in fields_map]
+        if not is_indices:
+            # Only extract the ip/useragent fields
+            parser.set_fields(fields_map.values())
         if is_indices:
             # Field index based matching
+            indices = [(key, int(field)-1) for key, field in fields]
             def _is_bot_func(line):
                 parsed_line = parser(line)
-                is_bot = False
-                if 'ua' in fields_map and parsed_line:
-                    is_bot = is_bot_ua_func(parsed_line.by_index(fields_map['ua']))
-                if not is_bot and 'ip' in fields_map:
-                    is_bot = parsed_line.by_index(fields_map['ip']) in bots_ips
-                return is_bot
+                values = {}
+                for key, index in indices:
+                    values[key] = parsed_line.by_index(index, raw=True)
+                return _is_bot(**values)
         else:
             # Named field based matching
             def _is_bot_func(line):
                 parsed_line = parser(line)
-                is_bot = False
-                if 'ua' in fields_map and parsed_line:
-                    is_bot = is_bot_ua_func(parsed_line[fields_map['ua']])
-                if not is_bot and 'ip' in fields_map:
-                    is_bot = parsed_line[fields_map['ip']] in bots_ips
-                return is_bot            
+                values = {}
+                for key, field in fields:
+                    values[key] = parsed_line[field]
+                return _is_bot(**values)
         
-    num_lines=0
-    num_filtered=0
-    num_nomatch=0
-    for line in imap(lambda x: x.strip(), fh):
-        try:
-            is_bot = _is_bot_func(line)
-        except (KeyError, ValueError):
-            # Parsing error
-            logging.warn("No match for line: %s", line)
-            num_nomatch +=1
-            continue
-
-        if is_bot ^ reverse:
-            logging.debug("Filtering line: %s", line)
-            num_filtered+=1
-            continue
-
-        num_lines+=1
+    counts = {}
+    if jobs > 1 and is_regular_file(fh):
+        lines = parallel_filter_lines(fh, _is_bot_func, reverse=reverse, 
+                                      counts=counts, jobs=jobs, stats=_cache_stats)
+    else:
+        lines = filter_lines(fh, _is_bot_func, reverse=reverse, counts=counts)
+    for line in lines:
         yield line
 
-    logging.info("Number of lines after bot filtering: %s", num_lines)
-    logging.info("Number of lines (bots) filtered: %s", num_filtered)        
-    if num_nomatch:
-        logging.info("Number of lines could not match on: %s", num_nomatch)
+    for watcher in watchers.values():
+        watcher.stop()
+    for key, value in _cache_stats().iteritems():
+        # Serial mode, or verdicts cached by the calling process
+        counts[key] = counts.get(key, 0) + value
+
+    logging.info("Number of lines after bot filtering: %s", counts['lines'])
+    logging.info("Number of lines (bots) filtered: %s", counts['filtered'])        
+    if counts['nomatch']:
+        logging.info("Number of lines could not match on: %s", counts['nomatch'])
+    for key, name in (('ua', 'Useragent'), ('ip', 'IP')):
+        if key in caches:
+            logging.info("%s verdict cache hits/misses: %s/%s", name, 
+                         counts[key + '_hits'], counts[key + '_misses'])
+    if detector is not None:
+        logging.info("Number of clients flagged by pattern analysis: %s", len(detector.flagged))
+        if pattern_counts['bad_ts']:
+            logging.info("Number of lines with undecodable timestamps (not analyzed): %s", 
+                         pattern_counts['bad_ts'])
 
     return
 
@@ -237,10 +454,10 @@ def filterbots_main():
     """Console entry-point"""
     options, args = filterbots_parse_args()
     if options.printlines:
-        for line in filterbots(fh=sys.stdin, *args, **options):
+        for line in filterbots(fh=open_inputs(args), **options):
             print line
     else:
-        for line in filterbots(fh=sys.stdin, *args, **options): 
+        for line in filterbots(fh=open_inputs(args), **options): 
             pass
 
     return 0
@@ -24,6 +24,7 @@ from json import dumps, load
 from optparse import OptionParser
 
 from _config import interpolate_config, AttrDict
+from logtools.readers import open_inputs
 
 
 __all__ = ['flattenjson_parse_args', 'flattenjson', 'flattenjson_main']
@@ -51,7 +52,7 @@ def flattenjson(options, args, fh):
 def flattenjson_main():
     """Console entry-point"""
     options, args = flattenjson_parse_args()
-    for row in flattenjson(options, args, fh=sys.stdin):
+    for row in flattenjson(options, args, fh=open_inputs(args)):
         if row:
             print row.encode('utf-8', 'ignore')
     return 0
@@ -24,6 +24,7 @@ from itertools import imap
 from optparse import OptionParser
 
 from _config import logtools_config, interpolate_config, AttrDict
+from logtools.readers import open_inputs
 
 __all__ = ['geoip_parse_args', 'geoip', 'geoip_main']
 
@@ -90,7 +91,7 @@ def geoip(fh, ip_re, **kwargs):
 def geoip_main():
     """Console entry-point"""
     options, args = geoip_parse_args()
-    for geocode, ip, line in geoip(fh=sys.stdin, *args, **options):
+    for geocode, ip, line in geoip(fh=open_inputs(args), **options):
         if options.printline is True:
             print "{0}\t{1}".format(geocode, line)
         else:
@@ -24,13 +24,14 @@ import sys
 import logging
 import unicodedata
 from time import time
-from itertools import imap
+from itertools import imap, izip
 from datetime import datetime
 from optparse import OptionParser
 from urlparse import parse_qs, urlsplit
 
 from logtools.join_backends import *
 from _config import logtools_config, interpolate_config, AttrDict
+from logtools.readers import open_inputs, timed_batches
 
 __all__ = ['logjoin_parse_args', 'logjoin', 'logjoin_main']
 
@@ -56,6 +57,11 @@ def logjoin_parse_args():
                       help="Name of resource to join to (e.g file name, table name)")        
     parser.add_option("-K", "--join-remote-key", dest="join_remote_key",
                       help="Name of remote key field to join on (e.g table field, file column index)")        
+    parser.add_option("-B", "--batch-size", dest="batch_size", type=int,
+                      help="Number of rows joined at a time, using a single query (default: 500, 1 to join row by row)")
+    parser.add_option("-L", "--max-latency", dest="max_latency", type=float,
+                      help="Maximum time (seconds) a row is buffered before its batch is joined, " \
+                      "e.g when input is a slow stream (default: 1.0, 0 to wait for full batches)")
     
     parser.add_option("-P", "--profile", dest="profile", default='qps',
                       help="Configuration profile (section in configuration file)")
@@ -71,13 +77,20 @@ def logjoin_parse_args():
     options.join_remote_fields = interpolate_config(options.join_remote_fields, options.profile, 'join_remote_fields')
     options.join_remote_name = interpolate_config(options.join_remote_name, options.profile, 'join_remote_name')
     options.join_remote_key = interpolate_config(options.join_remote_key, options.profile, 'join_remote_key')
+    options.batch_size = interpolate_config(options.batch_size, options.profile, 'batch_size', 
+                                            default=500, type=int)
+    options.max_latency = interpolate_config(options.max_latency, options.profile, 'max_latency', 
+                                             default=1.0, type=float)
 
     return AttrDict(options.__dict__), args
 
 
 def logjoin(fh, field, delimiter, backend, join_connect_string, 
-            join_remote_fields, join_remote_name, join_remote_key, **kwargs):
-    """Perform a join"""
+            join_remote_fields, join_remote_name, join_remote_key, 
+            batch_size=500, max_latency=1.0, **kwargs):
+    """Perform a join. Rows are joined in batches of batch_size rows
+    (see JoinBackend.join_many), buffering a row for at most max_latency
+    seconds. Joined rows are emitted in input order"""
     
     field = field-1
     delimiter = unicode(delimiter)
@@ -87,15 +100,25 @@ def logjoin(fh, field, delimiter, backend, join_connect_string,
     }[backend](remote_fields=join_remote_fields, remote_name=join_remote_name, 
                        remote_key=join_remote_key, connect_string=join_connect_string)
     
-    for row in imap(lambda x: x.strip(), fh):
-        key = row.split(delimiter)[field]
-        for join_row in backend_impl.join(key):
-            yield key, unicode(row) + delimiter + delimiter.join(imap(unicode, join_row))
+    rows = imap(lambda x: x.strip(), fh)
+    if not batch_size or batch_size <= 1:
+        for row in rows:
+            key = row.split(delimiter)[field]
+            for join_row in backend_impl.join(key):
+                yield key, unicode(row) + delimiter + delimiter.join(imap(unicode, join_row))
+        return
+        
+    for batch in timed_batches(rows, batch_size, max_latency=max_latency):
+        keys = [row.split(delimiter)[field] for row in batch]
+        joined = backend_impl.join_many(keys)
+        for key, row in izip(keys, batch):
+            for join_row in joined.get(unicode(key), ()):
+                yield key, unicode(row) + delimiter + delimiter.join(imap(unicode, join_row))
 
 def logjoin_main():
     """Console entry-point"""
     options, args = logjoin_parse_args()
-    for key, row in logjoin(fh=sys.stdin, *args, **options):
+    for key, row in logjoin(fh=open_inputs(args), **options):
         print >> sys.stdout, unicodedata.normalize('NFKD', unicode(row))\
               .encode('ascii','ignore')
 
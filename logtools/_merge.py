@@ -21,14 +21,16 @@ combined sorted order (typically by date field)
 import os
 import re
 import sys
+import time
 import logging
-from itertools import imap
+from itertools import chain
 from datetime import datetime
 from optparse import OptionParser
 from heapq import heappush, heappop, merge
 
 from _config import logtools_config, interpolate_config, AttrDict
-import logtools.parsers
+from logtools.readers import keyed_batches, open_input, prefetch, READ_AHEAD
+from logtools.sortkeys import key_func_from_options
 
 __all__ = ['logmerge_parse_args', 'logmerge', 'logmerge_main']
 
@@ -48,7 +50,12 @@ def logmerge_parse_args():
     parser.add_option("-F", "--dateformat", dest="dateformat",
                       help="Format string for parsing date-time field (used with --datetime)")        
     parser.add_option("-p", "--parser", dest="parser", default=None, 
-                    help="Log format parser (e.g 'CommonLogFormat'). See documentation for available parsers.")
+                    help="Log format parser (e.g 'CommonLogFormat'). See documentation for available parsers, or use 'auto' to detect the log format.")
+    parser.add_option("--prefetch", dest="prefetch", type=int, default=None,
+                    help="Number of (keyed) line batches read ahead per input file by a background reader thread, " \
+                    "hiding I/O latency e.g on network storage (default: %d, 0 to disable)" % READ_AHEAD)
+    parser.add_option("--bench", dest="bench", default=None, action="store_true",
+                    help="Report number of lines and lines/sec read (and keyed) per input file, and merge throughput")
     
     parser.add_option("-P", "--profile", dest="profile", default='logmerge',
                       help="Configuration profile (section in configuration file)")
@@ -68,40 +75,60 @@ def logmerge_parse_args():
                                     options.profile, 'dateformat', default=False)    
     options.parser = interpolate_config(options.parser, 
                                     options.profile, 'parser', default=False)    
+    options.prefetch = interpolate_config(options.prefetch, options.profile, 
+                                    'prefetch', default=READ_AHEAD, type=int)
+    options.bench = interpolate_config(options.bench, options.profile, 
+                                    'bench', default=False, type=bool)     
 
     return AttrDict(options.__dict__), args
 
+def _keyed_batches(filename, key_func, stats=None):
+    """Yield batches of (key, line) tuples read from file"""
+    with open_input(filename) as fh:
+        for keyed in keyed_batches(fh, key_func, stats):
+            yield keyed
+
+def _log_bench(args, stats, lines, seconds):
+    """Log merge throughput report"""
+    for filename, input_stats in zip(args, stats):
+        logging.info("%s: %d lines, %.0f lines/sec", filename, input_stats['lines'],
+                     input_stats['lines'] / max(input_stats['seconds'], 1e-6))
+    logging.info("Merged %d lines in %.2f seconds, %.0f lines/sec", lines, seconds, 
+                 lines / max(seconds, 1e-6))
+
 def logmerge(options, args):
     """Perform merge on multiple input logfiles
-    and emit in sorted order using a priority queue"""
+    and emit in sorted order using a priority queue.
+    Inputs are read in large (memory-mapped) blocks, 
+    and keyed a batch of lines at a time. Unless disabled,
+    each input is read and keyed by a background reader
+    thread, a few batches ahead of the merge"""
+    key_func = key_func_from_options(options, args)
+    prefetch_size = options.get('prefetch', READ_AHEAD)
     
-    delimiter = options.delimiter
-    field = options.field
-
-    key_func = None
-    if options.get('parser', None):
-        # Use a parser to extract field to merge/sort by
-        parser = eval(options.parser, vars(logtools.parsers), {})()
-        if field.isdigit():            
-            extract_func = lambda x: parser(x.strip()).by_index(int(field)-1)
-        else:
-            extract_func = lambda x: parser(x.strip())[field]
-    else:
-        # No parser given, use indexed field based extraction
-        extract_func = lambda x: x.strip().split(delimiter)[int(field)-1]
-        
-    if options.get('numeric', None):
-        key_func = lambda x: (int(extract_func(x)), x)
-    elif options.get('datetime', None):
-        key_func = lambda x: (datetime.strptime(extract_func(x), \
-                                    options.dateformat), x)            
-    else:
-        key_func = lambda x: (extract_func(x), x)
-        
-    iters = (imap(key_func, open(filename, "r")) for filename in args)
+    stats = None
+    if options.get('bench', None):
+        stats = [{'lines': 0, 'seconds': 0} for filename in args]
+        start = time.time()
+    iters = []
+    for i, filename in enumerate(args):
+        input_key_func = key_func
+        if prefetch_size and i > 0:
+            # Parsers reuse a single parsed line object across calls, 
+            # so each reader thread gets its own key function
+            input_key_func = key_func_from_options(options, args)
+        batches = _keyed_batches(filename, input_key_func, stats and stats[i])
+        if prefetch_size:
+            batches = prefetch(batches, size=prefetch_size, name=filename)
+        iters.append(chain.from_iterable(batches))
     
+    lines = 0
     for k, line in merge(*iters):
-        yield k, line.strip()
+        lines += 1
+        yield k, line
+        
+    if stats is not None:
+        _log_bench(args, stats, lines, time.time() - start)
     
 def logmerge_main():
     """Console entry-point"""
@@ -22,7 +22,9 @@ from operator import and_
 from optparse import OptionParser
 
 import logtools.parsers
+from logtools.detect import detect_stream_parser
 from _config import interpolate_config, AttrDict
+from logtools.readers import open_inputs
 
 __all__ = ['logparse_parse_args', 'logparse', 'logparse_main']
 
@@ -30,7 +32,7 @@ __all__ = ['logparse_parse_args', 'logparse', 'logparse_main']
 def logparse_parse_args():
     parser = OptionParser()
     parser.add_option("-p", "--parser", dest="parser", default=None,
-                      help="Log format parser (e.g 'CommonLogFormat'). See documentation for available parsers.")  # noqa
+                      help="Log format parser (e.g 'CommonLogFormat'). See documentation for available parsers, or use 'auto' to detect the log format.")  # noqa
     parser.add_option("-F", "--format", dest="format", default=None,
                       help="Format string. Used by the parser (e.g AccessLog format specifier)")  # noqa
     parser.add_option("-f", "--field", dest="field", default=None,
@@ -64,9 +66,12 @@ def logparse(options, args, fh):
 
     field = options.field
 
-    parser = eval(options.parser, vars(logtools.parsers), {})()
-    if options.get('format', None):
-        parser.set_format(options.format)
+    if options.parser == 'auto':
+        parser, fh = detect_stream_parser(fh)
+    else:
+        parser = logtools.parsers.get_parser(options.parser)
+        if options.get('format', None):
+            parser.set_format(options.format)
 
     keyfunc = None
     keys = None
@@ -82,11 +87,14 @@ def logparse(options, args, fh):
         # Check how many fields are requested
         keys = options.field.split(",")
         L = len(keys)
+        is_indices = reduce(and_, (k.isdigit() for k in keys), True)
+        if not is_indices:
+            # Only extract the requested fields
+            parser.set_fields(keys)
         if L == 1:
             key_func = lambda x: parser(x.strip())[field]
         else:
             # Multiple fields requested
-            is_indices = reduce(and_, (k.isdigit() for k in keys), True)
             key_func = logtools.parsers.multikey_getter_gen(parser, keys,
                                         is_indices=is_indices)
 
@@ -112,7 +120,7 @@ def logparse(options, args, fh):
 def logparse_main():
     """Console entry-point"""
     options, args = logparse_parse_args()
-    for row in logparse(options, args, fh=sys.stdin):
+    for row in logparse(options, args, fh=open_inputs(args)):
         if row:
             print row.encode('ascii', 'ignore')
     return 0
@@ -30,6 +30,8 @@ from optparse import OptionParser
 from abc import ABCMeta, abstractmethod
 
 from _config import logtools_config, interpolate_config, AttrDict
+from logtools.readers import open_inputs
+from logtools.timestamps import get_timestamp_parser
 
 __all__ = ['logplot_parse_args', 'logplot', 'logplot_main']
 
@@ -148,12 +150,13 @@ class GChartBackend(PlotBackend):
         delimiter = options.delimiter
         field = options.field-1
         datefield = options.datefield-1
+        parse_dt = get_timestamp_parser(options.dateformat)
         
         pts = []
         for l in imap(lambda x: x.strip(), fh):
             splitted_line = l.split(delimiter)
             v = float(splitted_line[field])
-            t = datetime.strptime(splitted_line[datefield], options.dateformat)
+            t = parse_dt(splitted_line[datefield])
             pts.append((t, v))
         
         if options.get('limit', None):
@@ -327,13 +330,14 @@ class MatplotlibBackend(PlotBackend):
         delimiter = options.delimiter
         field = options.field-1
         datefield = options.datefield-1
+        parse_dt = get_timestamp_parser(options.dateformat)
         
         pts = []
         max_y = -float("inf")
         for l in imap(lambda x: x.strip(), fh):
             splitted_line = l.split(delimiter)
             v = float(splitted_line[field])
-            t = datetime.strptime(splitted_line[datefield], options.dateformat)
+            t = parse_dt(splitted_line[datefield])
             pts.append((t, v))
             if v > max_y:
                 max_y = v
@@ -419,5 +423,5 @@ def logplot(options, args, fh):
 def logplot_main():
     """Console entry-point"""
     options, args = logplot_parse_args()
-    logplot(options, args, fh=sys.stdin)
+    logplot(options, args, fh=open_inputs(args))
     return 0
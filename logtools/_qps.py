@@ -25,6 +25,8 @@ from datetime import datetime
 from optparse import OptionParser
 
 from _config import logtools_config, interpolate_config, AttrDict
+from logtools.readers import open_inputs
+from logtools.timestamps import get_timestamp_parser
 
 __all__ = ['qps_parse_args', 'qps', 'qps_main']
 
@@ -67,6 +69,7 @@ def qps(fh, dt_re, dateformat, window_size, ignore, **kwargs):
     parsing of timestamps and using a sliding time window"""
     
     _re = re.compile(dt_re)
+    _parse_dt = get_timestamp_parser(dateformat)
     t0=None
     samples=[]
 
@@ -76,7 +79,7 @@ def qps(fh, dt_re, dateformat, window_size, ignore, **kwargs):
         if not line:
             return
         try:
-            t = datetime.strptime(_re.match(line).groups()[0], dateformat)
+            t = _parse_dt(_re.match(line).groups()[0])
         except (AttributeError, KeyError, TypeError, ValueError):
             if ignore:
                 logging.debug("Could not match datefield for parsed line: %s", line)
@@ -91,7 +94,7 @@ def qps(fh, dt_re, dateformat, window_size, ignore, **kwargs):
     # Run over rest of input stream
     for line in imap(lambda x: x.strip(), fh):
         try:
-            t = datetime.strptime(_re.match(line).groups()[0], dateformat)
+            t = _parse_dt(_re.match(line).groups()[0])
         except (AttributeError, KeyError, TypeError, ValueError):
             if ignore:
                 logging.debug("Could not match datefield for parsed line: %s", line)
@@ -127,7 +130,7 @@ def qps(fh, dt_re, dateformat, window_size, ignore, **kwargs):
 def qps_main():
     """Console entry-point"""
     options, args = qps_parse_args()
-    for qps_info in qps(fh=sys.stdin, *args, **options):
+    for qps_info in qps(fh=open_inputs(args), **options):
         print >> sys.stdout, "{start_time}\t{end_time}\t{num_samples}\t{qps:.2f}".format(**qps_info)
 
     return 0
@@ -26,6 +26,7 @@ from optparse import OptionParser
 from heapq import heappush, heappop, heapreplace
 
 from _config import logtools_config, interpolate_config, AttrDict
+from logtools.readers import open_inputs
 
 __all__ = ['logsample_parse_args', 'logsample', 'logsample_weighted', 'logsample_main']
 
@@ -116,10 +117,10 @@ def logsample_main():
     options, args = logsample_parse_args()
     
     if options.weighted is True:
-        for k, r in logsample_weighted(fh=sys.stdin, *args, **options):
+        for k, r in logsample_weighted(fh=open_inputs(args), **options):
             print r
     else:
-        for r in logsample(fh=sys.stdin, *args, **options):
+        for r in logsample(fh=open_inputs(args), **options):
             print r
         
     return 0
@@ -30,6 +30,7 @@ from optparse import OptionParser
 from abc import ABCMeta, abstractmethod
 
 from _config import logtools_config, interpolate_config, AttrDict
+from logtools.readers import open_inputs
 
 __all__ = ['logserve_parse_args', 'logserve', 'logserve_main']
 
@@ -46,5 +47,5 @@ def logserve(options, args, fh):
 def logserve_main():
     """Console entry-point"""
     options, args = logserve_parse_args()
-    logserve(options, args, fh=sys.stdin)
+    logserve(options, args, fh=open_inputs(args))
     return 0
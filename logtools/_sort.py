@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+logtools._sort
+Logfile sorting utilities. Sorts (possibly unsorted) input
+logstreams in bounded memory, using the same key specifications
+as logmerge: Input is sorted in chunks, which are spilled into
+temporary files as sorted runs, and then merged.
+"""
+import os
+import cPickle
+import logging
+from heapq import merge
+from itertools import chain
+from tempfile import mkstemp
+from collections import deque
+from optparse import OptionParser
+from multiprocessing import Pool
+
+from _config import interpolate_config, AttrDict
+import logtools.parsers
+from logtools.detect import detect_stream_parser
+from logtools.readers import line_batches, open_inputs
+from logtools.sortkeys import make_key_func
+
+__all__ = ['logsort_parse_args', 'logsort', 'logsort_main']
+
+# State inherited by forked worker processes (see logsort)
+_key_func = None
+_tmp_dir = None
+
+# Number of (key, line) records per pickled batch in run files.
+# One batch per run is held in memory while merging
+RUN_BATCH_SIZE = 4096
+
+
+def logsort_parse_args():
+    usage = "%prog -f <field> -d <delimiter> [filename1 filename2 ...]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("-f", "--field", dest="field", default=None,
+                    help="Field index to use as key for sorting by (1-based)")
+    parser.add_option("-d", "--delimiter", dest="delimiter", default=None,
+                    help="Delimiter character for fields in logfile")
+    parser.add_option("-n", "--numeric", dest="numeric", default=None, action="store_true",
+                    help="Parse key field value as numeric and sort accordingly")
+    parser.add_option("-t", "--datetime", dest="datetime", default=None, action="store_true",
+                    help="Parse key field value as a date/time timestamp and sort accordingly")
+    parser.add_option("-F", "--dateformat", dest="dateformat",
+                      help="Format string for parsing date-time field (used with --datetime)")
+    parser.add_option("-p", "--parser", dest="parser", default=None,
+                    help="Log format parser (e.g 'CommonLogFormat'). See documentation for available parsers, or use 'auto' to detect the log format.")
+    parser.add_option("-S", "--chunk-size", dest="chunk_size", type=int, default=None,
+                    help="Number of lines sorted in memory at a time. Larger inputs are sorted in chunks, " \
+                    "spilled to temporary files and merged (default: 1000000)")
+    parser.add_option("-T", "--temporary-directory", dest="tmp_dir", default=None,
+                    help="Directory for temporary files (default: system temporary directory)")
+    parser.add_option("-j", "--jobs", dest="jobs", type=int, default=None,
+                    help="Number of worker processes to sort chunks with")
+
+    parser.add_option("-P", "--profile", dest="profile", default='logsort',
+                      help="Configuration profile (section in configuration file)")
+
+    options, args = parser.parse_args()
+
+    # Interpolate from configuration
+    options.field = interpolate_config(options.field,
+                                    options.profile, 'field')
+    options.delimiter = interpolate_config(options.delimiter,
+                                    options.profile, 'delimiter', default=' ')
+    options.numeric = interpolate_config(options.numeric, options.profile,
+                                    'numeric', default=False, type=bool)
+    options.datetime = interpolate_config(options.datetime, options.profile,
+                                    'datetime', default=False, type=bool)
+    options.dateformat = interpolate_config(options.dateformat,
+                                    options.profile, 'dateformat', default=False)
+    options.parser = interpolate_config(options.parser,
+                                    options.profile, 'parser', default=False)
+    options.chunk_size = interpolate_config(options.chunk_size,
+                                    options.profile, 'chunk_size', default=1000000, type=int)
+    options.tmp_dir = interpolate_config(options.tmp_dir,
+                                    options.profile, 'tmp_dir', default=False)
+    options.jobs = interpolate_config(options.jobs,
+                                    options.profile, 'jobs', default=1, type=int)
+
+    return AttrDict(options.__dict__), args
+
+def _chunks(fh, chunk_size):
+    """Yield lists of up to chunk_size (stripped) lines"""
+    chunk = []
+    for batch in line_batches(fh):
+        chunk.extend(batch)
+        while len(chunk) >= chunk_size:
+            yield chunk[:chunk_size]
+            chunk = chunk[chunk_size:]
+    if chunk:
+        yield chunk
+
+def _sort_run(lines):
+    """Sort chunk of lines and spill it into a temporary file as a
+    sorted run of pickled batches of (key, line) records, so that
+    lines need not be keyed again when merging. Returns the run filename"""
+    keyed = map(_key_func, lines)
+    keyed.sort()
+    fd, filename = mkstemp(prefix='logsort-', suffix='.run', dir=_tmp_dir or None)
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            for batch_start in xrange(0, len(keyed), RUN_BATCH_SIZE):
+                cPickle.dump(keyed[batch_start:batch_start+RUN_BATCH_SIZE], fh, 
+                             cPickle.HIGHEST_PROTOCOL)
+    except:
+        os.remove(filename)
+        raise
+    return filename
+
+def _read_run(fh):
+    """Yield batches of (key, line) records from a run file"""
+    while True:
+        try:
+            yield cPickle.load(fh)
+        except EOFError:
+            return
+
+def _spill_runs(chunks, jobs, runs):
+    """Sort and spill chunks into runs, using a pool of worker
+    processes if jobs > 1. Run filenames are appended to runs"""
+    if jobs <= 1:
+        for chunk in chunks:
+            runs.append(_sort_run(chunk))
+        return
+
+    pool = Pool(jobs)
+    try:
+        # Keep a bounded number of chunks in flight
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_sort_run, (chunk,)))
+            while len(pending) >= jobs:
+                runs.append(pending.popleft().get())
+        while pending:
+            runs.append(pending.popleft().get())
+    finally:
+        pool.terminate()
+        pool.join()
+
+def logsort(fh, field, delimiter=' ', numeric=False, datetime=False, dateformat=None,
+            parser=None, chunk_size=1000000, tmp_dir=None, jobs=1, **kwargs):
+    """Sort input logstream by given key field (see logmerge for
+    key specification options), in bounded memory. Input is sorted
+    in chunks of chunk_size lines. Inputs larger than a single chunk
+    are spilled to temporary files as sorted runs, and merged.
+    Emits (key, line) tuples in sorted order"""
+    global _key_func, _tmp_dir
+
+    if parser == 'auto':
+        parser, fh = detect_stream_parser(fh)
+    elif parser:
+        parser = logtools.parsers.get_parser(parser)
+    else:
+        parser = None
+    key_func = make_key_func(field, delimiter=delimiter, numeric=numeric, datetime=datetime,
+                             dateformat=dateformat, parser=parser)
+
+    chunks = _chunks(fh, chunk_size)
+    head = [next(chunks, [])]
+    try:
+        head.append(next(chunks))
+    except StopIteration:
+        # Input fits in memory
+        keyed = map(key_func, head.pop())
+        keyed.sort()
+        for key, line in keyed:
+            yield key, line
+        return
+        
+    def _all_chunks():
+        while head:
+            yield head.pop(0)
+        for chunk in chunks:
+            yield chunk
+
+    _key_func, _tmp_dir = key_func, tmp_dir
+    runs = []
+    run_fhs = []
+    try:
+        _spill_runs(_all_chunks(), jobs, runs)
+        logging.info("Merging %d sorted runs", len(runs))
+
+        for filename in runs:
+            run_fhs.append(open(filename, 'rb'))
+        iters = [chain.from_iterable(_read_run(run_fh)) for run_fh in run_fhs]
+        for key, line in merge(*iters):
+            yield key, line
+    finally:
+        # Also on errors, interrupts, or when consumer stops early
+        _key_func = _tmp_dir = None
+        for run_fh in run_fhs:
+            run_fh.close()
+        for filename in runs:
+            os.remove(filename)
+
+def logsort_main():
+    """Console entry-point"""
+    options, args = logsort_parse_args()
+    for key, line in logsort(fh=open_inputs(args), **options):
+        print line
+    return 0
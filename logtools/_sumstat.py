@@ -33,6 +33,7 @@ from optparse import OptionParser
 from prettytable import PrettyTable
 
 from _config import interpolate_config, AttrDict
+from logtools.readers import open_inputs
 
 
 __all__ = ['sumstat_parse_args', 'sumstat', 'sumstat_main']
@@ -133,7 +134,7 @@ def sumstat(fh, delimiter, reverse=False, **kwargs):
 def sumstat_main():
     """Console entry-point"""
     options, args = sumstat_parse_args()
-    stat_dict = sumstat(fh=sys.stdin, *args, **options)
+    stat_dict = sumstat(fh=open_inputs(args), **options)
 
     table = PrettyTable([
         "Num. Samples / Cumulative Value (N)",
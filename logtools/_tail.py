@@ -29,14 +29,18 @@ from optparse import OptionParser
 import dateutil.parser
 
 from _config import logtools_config, interpolate_config, AttrDict
+from logtools.readers import open_inputs
+from logtools.timestamps import get_timestamp_parser
 import logtools.parsers
+from logtools.detect import detect_stream_parser
 
 __all__ = ['logtail_parse_args', 'logtail', 
            'logtail_main']
 
-def _is_match_full(val, date_format, dt_start):
-    """Perform filtering on line"""
-    dt = datetime.strptime(val, date_format)
+def _is_match_full(val, parse_dt, dt_start):
+    """Perform filtering on line. val is a timestamp string,
+    or a datetime already decoded by a parser (e.g %t)"""
+    dt = val if isinstance(val, datetime) else parse_dt(val)
     if dt >= dt_start:
         return True
     return False    
@@ -57,7 +61,8 @@ def logtail_parse_args():
 
     parser.add_option("--parser", dest="parser",
                       help="Feed logs through a parser. Useful when reading encoded/escaped formats (e.g JSON) and when " \
-                      "selecting parsed fields rather than matching via regular expression.")
+                      "selecting parsed fields rather than matching via regular expression. " \
+                      "Use 'auto' to detect the log format from the input.")
     parser.add_option("-d", "--delimiter", dest="delimiter",
                       help="Delimiter character for field-separation (when not using a --parser)")        
     parser.add_option("-f", "--field", dest="field",
@@ -91,23 +96,31 @@ def logtail(fh, date_format, start_date, field, parser=None, delimiter=None,
     date range."""
             
     dt_start = dateutil.parser.parse(start_date)
-    _is_match = partial(_is_match_full, date_format=date_format, dt_start=dt_start)
+    _is_match = partial(_is_match_full, parse_dt=get_timestamp_parser(date_format), 
+                        dt_start=dt_start)
    
     _is_match_func = _is_match
     if parser:
         # Custom parser specified, use field-based matching
-        parser = eval(parser, vars(logtools.parsers), {})()
+        if parser == 'auto':
+            parser, fh = detect_stream_parser(fh)
+        else:
+            parser = logtools.parsers.get_parser(parser)
         is_indices = field.isdigit()
+        if not is_indices:
+            # Only extract the date field
+            parser.set_fields([field])
         if is_indices:
             # Field index based matching
+            index = int(field) - 1
             def _is_match_func(line):
                 parsed_line = parser(line)
-                return _is_match(parsed_line.by_index(field))
+                return _is_match(parsed_line.by_index(index))
         else:
             # Named field based matching
             def _is_match_func(line):
                 parsed_line = parser(line)
-                return _is_match(parsed_line.by_index(field))
+                return _is_match(parsed_line.by_key(field))
     else:
         # No custom parser, field/delimiter-based extraction
         def _is_match_func(line):
@@ -145,10 +158,10 @@ def logtail_main():
     """Console entry-point"""
     options, args = logtail_parse_args()
     if options.printlines:
-        for line in logtail(fh=sys.stdin, *args, **options):
+        for line in logtail(fh=open_inputs(args), **options):
             print line
     else:
-        for line in logtail(fh=sys.stdin, *args, **options): 
+        for line in logtail(fh=open_inputs(args), **options): 
             pass
 
     return 0
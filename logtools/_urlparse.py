@@ -28,6 +28,7 @@ from optparse import OptionParser
 from urlparse import parse_qs, urlsplit
 
 from _config import logtools_config, interpolate_config, AttrDict
+from logtools.readers import open_inputs
 
 __all__ = ['urlparse_parse_args', 'urlparse', 'urlparse_main']
 
@@ -90,7 +91,7 @@ def urlparse(fh, part=None, query_params=None, decode=False, **kwargs):
 def urlparse_main():
     """Console entry-point"""
     options, args = urlparse_parse_args()
-    for parsed_url in urlparse(fh=sys.stdin, *args, **options):
+    for parsed_url in urlparse(fh=open_inputs(args), **options):
         if parsed_url:
             if hasattr(parsed_url, '__iter__'):
                 # Format as tab-delimited for output
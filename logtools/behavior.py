@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+logtools.behavior
+Streaming behavioral bot detection, used by filterbots --pattern.
+Clients (e.g ip/useragent pairs) are flagged when their request rate
+over a sliding window, number of distinct paths requested within a window,
+or regularity of request inter-arrival times exceed given thresholds.
+All per-client state is fixed-size, and the number of tracked clients is
+bounded, so memory use stays flat regardless of the number of clients.
+"""
+import logging
+from math import log, sqrt
+
+from logtools.utils import ClockCache
+
+__all__ = ['BehaviorDetector']
+
+
+class _ClientState(object):
+    """Fixed-size per-client detector state"""
+    __slots__ = ('window_start', 'count', 'prev_count', 'paths',
+                 'last_seen', 'num_gaps', 'gap_mean', 'gap_var')
+
+    def __init__(self):
+        self.window_start = None
+        self.count = 0
+        self.prev_count = 0
+        self.paths = 0
+        self.last_seen = None
+        self.num_gaps = 0
+        self.gap_mean = 0.0
+        self.gap_var = 0.0
+
+
+class BehaviorDetector(object):
+    """Streaming behavioral bot detector. Call with a client key,
+    request timestamp (epoch seconds) and optionally requested path,
+    for each request in order. Returns True if client is flagged as a bot,
+    either by this request or earlier ones.
+
+    Detection rules:
+     - Request rate: more than max_requests within a sliding window of
+       window seconds (approximated from counts of the current and
+       previous fixed windows)
+     - Distinct paths: more than max_paths distinct paths within a window
+       (estimated by linear counting over a fixed-size bitmap)
+     - Regularity: at least min_samples requests, with the coefficient of
+       variation of inter-arrival times (exponentially weighted) below
+       max_gap_cv, i.e requests issued at suspiciously fixed intervals
+
+    At most max_clients clients are tracked, least recently active ones
+    being evicted (CLOCK policy), and at most max_clients flagged clients
+    are remembered. If given, on_flag is called with the client key and
+    the name of the triggered rule whenever a client is flagged"""
+
+    # Bitmap size used for estimating distinct paths
+    PATHS_BITMAP_SIZE = 512
+
+    # Smoothing factor for inter-arrival time statistics
+    GAP_ALPHA = 0.1
+
+    def __init__(self, window=60, max_requests=120, max_paths=100,
+                 max_gap_cv=0.1, min_samples=20, max_clients=100000, on_flag=None):
+        self.window = window
+        self.max_requests = max_requests
+        self.max_paths = max_paths
+        self.max_gap_cv = max_gap_cv
+        self.min_samples = min_samples
+        self.max_clients = max_clients
+        self.on_flag = on_flag
+        self.flagged = {}
+        self._clients = ClockCache(lambda key: _ClientState(), maxsize=max_clients)
+
+    def __call__(self, key, timestamp, path=None):
+        if key in self.flagged:
+            return True
+        reason = self._update(self._clients(key), timestamp, path)
+        if reason is None:
+            return False
+
+        if len(self.flagged) < self.max_clients:
+            self.flagged[key] = reason
+        else:
+            logging.debug("Flagged clients limit reached, not remembering: %s", key)
+        logging.info("Flagged client by %s pattern: %s", reason, key)
+        if self.on_flag is not None:
+            self.on_flag(key, reason)
+        return True
+
+    def _update(self, state, timestamp, path):
+        """Update client state with request. Returns name
+        of detection rule triggered, if any"""
+        window = self.window
+
+        # Request rate
+        if state.window_start is None:
+            state.window_start = timestamp
+        elapsed = timestamp - state.window_start
+        if elapsed >= window:
+            # Start new window, carrying over previous count
+            # only if windows are consecutive
+            state.prev_count = elapsed < 2 * window and state.count or 0
+            state.window_start += (elapsed // window) * window
+            state.count = 0
+            state.paths = 0
+            elapsed = timestamp - state.window_start
+        state.count += 1
+        rate = state.count + state.prev_count * (1 - elapsed / float(window))
+        if rate > self.max_requests:
+            return 'rate'
+
+        # Distinct paths
+        if path is not None:
+            state.paths |= 1 << (hash(path) % self.PATHS_BITMAP_SIZE)
+            if self._num_distinct(state.paths) > self.max_paths:
+                return 'paths'
+
+        # Inter-arrival regularity
+        if state.last_seen is not None:
+            gap = max(timestamp - state.last_seen, 0)
+            if state.num_gaps == 0:
+                state.gap_mean = float(gap)
+            else:
+                diff = gap - state.gap_mean
+                incr = self.GAP_ALPHA * diff
+                state.gap_mean += incr
+                state.gap_var = (1 - self.GAP_ALPHA) * (state.gap_var + diff * incr)
+            state.num_gaps += 1
+            if state.num_gaps >= self.min_samples and state.gap_mean > 0 and \
+               sqrt(state.gap_var) / state.gap_mean < self.max_gap_cv:
+                return 'regularity'
+        state.last_seen = timestamp
+        return None
+
+    def _num_distinct(self, bitmap):
+        """Linear counting estimate of number of distinct values in bitmap"""
+        size = self.PATHS_BITMAP_SIZE
+        zeros = size - bin(bitmap).count('1')
+        if zeros == 0:
+            return float('inf')
+        return -size * log(zeros / float(size))
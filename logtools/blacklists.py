@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+logtools.blacklists
+Compact representations of large blacklists. Exact-match blacklists
+(e.g IP address lists) can be stored as a sorted array of 64-bit
+hashes in a file, which is memory-mapped on later runs, so that startup
+is near instant and memory use is shared through the page cache.
+Compiled forms of blacklists can also be cached on disk, keyed by
+the blacklist contents and compilation options, and rebuilt in the
+background when their source files change. IP blacklists may contain
+CIDR ranges, which are matched using a sorted interval array.
+"""
+import os
+import mmap
+import socket
+import struct
+import hashlib
+import logging
+import cPickle
+import threading
+from bisect import bisect_right
+from binascii import hexlify
+
+from logtools.utils import cache_dir, ClockCache
+
+__all__ = ['HashedSet', 'build_hashed_set', 'is_hashed_set', 'open_hashed_set',
+           'read_blacklist', 'cached_compile', 'WatchedBlacklist', 
+           'IPRangeSet', 'ip_to_int', 'parse_cidr']
+
+# Bumped whenever the format of cached compiled blacklists changes
+CACHE_VERSION = 1
+
+# File header: magic, number of hashes
+_MAGIC = 'LTHSET01'
+_HEADER = struct.Struct('<8sQ')
+_HASH = struct.Struct('<Q')
+_MAX_HASH = 2 ** 64 - 1
+
+
+def _hash(key):
+    """64-bit hash of a blacklist entry. For tens of millions
+    of entries, the probability of any false positive is ~1e-5"""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return _HASH.unpack_from(hashlib.md5(key).digest())[0]
+
+
+def read_blacklist(fh):
+    """Read blacklist entries from file, skipping comments"""
+    for line in fh:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def cached_compile(kind, lines, build_func, options=None, cache_path=None):
+    """Compile blacklist using build_func(lines), caching the (picklable)
+    result on disk. Cache entries are keyed by kind, blacklist contents
+    and given options dictionary, so any change to these triggers a rebuild"""
+    lines = list(lines)
+    key = hashlib.sha1(repr((CACHE_VERSION, kind, sorted((options or {}).items()))))
+    for line in lines:
+        # Length prefixed, so that different splits
+        # of the same contents hash differently
+        key.update("%d:" % len(line))
+        key.update(line)
+    cache_path = cache_path or os.path.join(cache_dir(), 'blacklists')
+    filename = os.path.join(cache_path, "%s-%s.pickle" % (kind, key.hexdigest()))
+
+    try:
+        with open(filename, 'rb') as fh:
+            compiled = cPickle.load(fh)
+        logging.debug("Loaded compiled blacklist from cache: %s", filename)
+        return compiled
+    except IOError:
+        pass
+    except Exception, exc:
+        # Corrupt/incompatible cache entry
+        logging.warn("Could not load compiled blacklist from cache: %s", exc)
+
+    compiled = build_func(lines)
+    try:
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as fh:
+            cPickle.dump(compiled, fh, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError, cPickle.PicklingError), exc:
+        logging.warn("Could not write compiled blacklist to cache: %s", exc)
+    return compiled
+
+
+def build_hashed_set(entries, filename):
+    """Build a hashed set file from given blacklist entries.
+    File is written to a temporary name and then renamed, so
+    that concurrent readers never see a partially written file"""
+    hashes = sorted(set(_hash(entry) for entry in entries))
+
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as fh:
+        fh.write(_HEADER.pack(_MAGIC, len(hashes)))
+        for i in xrange(0, len(hashes), 65536):
+            chunk = hashes[i:i+65536]
+            fh.write(struct.pack('<%dQ' % len(chunk), *chunk))
+    os.rename(tmp_filename, filename)
+    logging.info("Built hashed set of %d entries: %s", len(hashes), filename)
+
+
+def is_hashed_set(filename):
+    """Check whether given file is a hashed set file"""
+    try:
+        with open(filename, 'rb') as fh:
+            return fh.read(len(_MAGIC)) == _MAGIC
+    except IOError:
+        return False
+
+
+def open_hashed_set(filename, source=None):
+    """Open hashed set file. If source (blacklist file name) is given,
+    the hashed set is first (re)built from it if missing or outdated"""
+    if source is not None:
+        try:
+            outdated = os.path.getmtime(filename) < os.path.getmtime(source)
+        except OSError:
+            outdated = True
+        if outdated:
+            with open(source, 'r') as fh:
+                build_hashed_set(read_blacklist(fh), filename)
+    return HashedSet(filename)
+
+
+class HashedSet(object):
+    """Read-only, memory-mapped set of blacklist entries,
+    stored as a sorted array of 64-bit hashes. Supports
+    membership tests and len()"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._len = None, 0
+        if len(self._mm) >= _HEADER.size:
+            magic, self._len = _HEADER.unpack_from(self._mm)
+        if magic != _MAGIC or len(self._mm) != _HEADER.size + self._len * _HASH.size:
+            self._mm.close()
+            raise ValueError("Invalid hashed set file: %s" % filename)
+
+    def __contains__(self, key):
+        if not isinstance(key, basestring):
+            return False
+        h = _hash(key)
+        mm, unpack_from, offset = self._mm, _HASH.unpack_from, _HEADER.size
+        # Hashes are uniformly distributed, so interpolation search
+        # needs far fewer probes than a binary search
+        lo, hi = 0, self._len - 1
+        lo_value, hi_value = 0, _MAX_HASH
+        while lo <= hi:
+            if hi - lo < 16:
+                mid = (lo + hi) // 2
+            else:
+                mid = lo + int((h - lo_value) * (hi - lo) // (hi_value - lo_value))
+            value = unpack_from(mm, offset + mid * 8)[0]
+            if value < h:
+                lo, lo_value = mid + 1, value
+            elif value > h:
+                hi, hi_value = mid - 1, value
+            else:
+                return True
+        return False
+
+    def __len__(self):
+        return self._len
+
+    def close(self):
+        self._mm.close()
+
+
+def _file_signature(filename):
+    """Signature used to detect file changes"""
+    st = os.stat(filename)
+    return st.st_ino, st.st_size, st.st_mtime
+
+
+class WatchedBlacklist(object):
+    """Compiled blacklist which is rebuilt in a background thread 
+    whenever its source file changes. The compiled object (a predicate
+    or a container) is built using build_func(fh) and swapped in with a
+    single attribute assignment, so callers see either the old or the new
+    version, never a partially built one. Calls and membership tests are
+    delegated to the current compiled object. If given, on_reload() is
+    called after each reload (e.g to invalidate caches of results).
+    Failed rebuilds are retried on each poll, keeping the current version"""
+
+    def __init__(self, fh, build_func, interval=1.0, on_reload=None):
+        self.filename = fh.name
+        self.build_func = build_func
+        self.interval = interval
+        self.on_reload = on_reload
+        self._signature = _file_signature(self.filename)
+        self.current = build_func(fh)
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._watch,
+                                        name="watch:%s" % self.filename)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, *args, **kwargs):
+        return self.current(*args, **kwargs)
+
+    def __contains__(self, key):
+        return key in self.current
+
+    def __len__(self):
+        return len(self.current)
+
+    def _watch(self):
+        failed_signature = None
+        while not self._stopped.is_set():
+            self._stopped.wait(self.interval)
+            if self._stopped.is_set():
+                break
+            try:
+                signature = _file_signature(self.filename)
+            except OSError:
+                # Missing while being replaced, keep current version
+                continue
+            if signature == self._signature:
+                continue
+            try:
+                with open(self.filename, 'r') as fh:
+                    compiled = self.build_func(fh)
+            except Exception, exc:
+                # Retried on next poll (e.g file was still being written)
+                log = signature == failed_signature and logging.debug or logging.warn
+                log("Could not reload blacklist %s: %s", self.filename, exc)
+                failed_signature = signature
+            else:
+                self.current = compiled
+                self._signature = signature
+                if self.on_reload is not None:
+                    self.on_reload()
+                logging.info("Reloaded blacklist: %s", self.filename)
+
+    def stop(self):
+        """Stop watching source file for changes"""
+        self._stopped.set()
+        self._thread.join()
+
+
+def ip_to_int(ip):
+    """Convert IPv4/IPv6 address string into (address family, integer).
+    Raises ValueError for invalid addresses"""
+    family = ':' in ip and socket.AF_INET6 or socket.AF_INET
+    try:
+        packed = socket.inet_pton(family, ip)
+    except (socket.error, TypeError):
+        raise ValueError("Invalid IP address: '%s'" % ip)
+    return family, int(hexlify(packed), 16)
+
+
+def parse_cidr(cidr):
+    """Parse CIDR block (e.g '10.0.0.0/8') or single address
+    into (address family, first address, last address) integers"""
+    ip, _, prefix_len = cidr.partition('/')
+    family, address = ip_to_int(ip)
+    bits = family == socket.AF_INET6 and 128 or 32
+    if not prefix_len:
+        return family, address, address
+    try:
+        host_bits = bits - int(prefix_len)
+    except ValueError:
+        host_bits = -1
+    if not 0 <= host_bits <= bits:
+        raise ValueError("Invalid CIDR block: '%s'" % cidr)
+    start = address >> host_bits << host_bits
+    return family, start, start + (1 << host_bits) - 1
+
+
+class IPRangeSet(object):
+    """Set of IP addresses, given as single IPv4/IPv6 addresses or
+    CIDR blocks. Single IPv4 addresses are matched by exact string lookup, 
+    other entries are merged into sorted, non-overlapping intervals 
+    per address family and looked up with a binary search.
+    Address to integer conversions are cached"""
+
+    def __init__(self, entries, cache_size=10000):
+        self._exact = set()
+        intervals = {socket.AF_INET: [], socket.AF_INET6: []}
+        for entry in entries:
+            if '/' not in entry and ':' not in entry:
+                self._exact.add(entry)
+                continue
+            try:
+                family, start, end = parse_cidr(entry)
+            except ValueError, exc:
+                logging.warn("Skipping IP blacklist entry: %s", exc)
+                continue
+            intervals[family].append((start, end))
+
+        self._starts, self._ends = {}, {}
+        for family, family_intervals in intervals.iteritems():
+            starts, ends = [], []
+            for start, end in sorted(family_intervals):
+                if ends and start <= ends[-1] + 1:
+                    # Overlapping / adjacent, merge
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._starts[family], self._ends[family] = starts, ends
+        self._ip_to_int = ClockCache(ip_to_int, maxsize=cache_size)
+
+    def __contains__(self, ip):
+        if ip in self._exact:
+            return True
+        try:
+            family, address = self._ip_to_int(ip)
+        except (ValueError, TypeError):
+            # Invalid / missing address
+            return False
+        i = bisect_right(self._starts[family], address) - 1
+        return i >= 0 and address <= self._ends[family][i]
+
+    def __len__(self):
+        """Number of addresses and (merged) ranges"""
+        return len(self._exact) + sum([len(starts) for starts in self._starts.values()])
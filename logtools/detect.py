@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+logtools.detect
+Automatic detection of log formats. Candidate parsers are scored
+against a sample of the input lines, and the fastest parser matching
+the most lines is picked. Decisions for regular files are cached
+by file identity and modification time.
+Used by the command-line tools when given '--parser auto'.
+"""
+import os
+import json
+import stat
+import logging
+from time import time
+from itertools import chain, islice
+
+from logtools.parsers import get_parser
+from logtools.utils import cache_dir
+from logtools.readers import open_input
+
+__all__ = ['detect_parser', 'detect_stream_parser', 'detect_file_parser']
+
+# Candidate (parser name, format) pairs
+CANDIDATES = [
+    ('CommonLogFormat', None),
+    ('AccessLog', '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"'),
+    ('AccessLog', '%v:%p %h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"'),
+    ('JSONParser', None),
+    ('uWSGIParser', None)
+]
+
+# Max. number of cached detection results
+CACHE_SIZE = 1000
+
+
+def detect_parser(lines, candidates=CANDIDATES):
+    """Detect log format of given sample lines. Returns the
+    (parser name, format) candidate matching the most lines,
+    preferring the fastest one in case of a tie.
+    Raises ValueError if no candidate matches any line"""
+    lines = [l.rstrip('\r\n') for l in lines]
+    
+    best, best_score = None, (0, 0)
+    for name, format in candidates:
+        parser = get_parser(name, format=format)
+        matched = 0
+        t0 = time()
+        for line in lines:
+            try:
+                parser(line)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+            matched += 1
+        score = (matched, -(time() - t0))
+        logging.debug("Detection score for %s (%s): %s", name, format, score)
+        if matched and score > best_score:
+            best, best_score = (name, format), score
+            
+    if best is None:
+        raise ValueError("Could not detect log format")
+    return best
+
+
+def _cache_key(st):
+    """Key detection results by file identity"""
+    return "%d:%d" % (st.st_dev, st.st_ino)
+
+
+def _cached_detect(st, lines, cache_file=None):
+    """Return cached detection result for file (given its stat info),
+    running detection over sample lines if not cached or modified since"""
+    cache_file = cache_file or os.path.join(cache_dir(), 'detect.json')
+    key = _cache_key(st)
+    
+    try:
+        with open(cache_file, 'r') as fh:
+            cache = json.load(fh)
+    except (IOError, ValueError):
+        cache = {}
+        
+    entry = cache.get(key)
+    if entry and entry['mtime'] == st.st_mtime:
+        return entry['parser'], entry['format']
+    
+    name, format = detect_parser(lines())
+    if len(cache) >= CACHE_SIZE:
+        cache.clear()
+    cache[key] = {'mtime': st.st_mtime, 'parser': name, 'format': format}
+    
+    tmp_file = "%s.%d" % (cache_file, os.getpid())
+    try:
+        with open(tmp_file, 'w') as fh:
+            json.dump(cache, fh)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError), exc:
+        logging.warn("Could not write format detection cache: %s", exc)
+    return name, format
+
+
+def detect_stream_parser(fh, num_lines=100, cache_file=None):
+    """Detect log format of input stream and return a parser instance
+    for it, along with an iterable over all the lines of the stream,
+    including the sampled ones. Results are cached for regular files"""
+    try:
+        st = os.fstat(fh.fileno())
+    except (AttributeError, ValueError, IOError, OSError):
+        st = None
+        
+    if st is not None and stat.S_ISREG(st.st_mode):
+        # Regular file, rewind after reading sample
+        pos = fh.tell()
+        def lines():
+            sample = [fh.readline() for i in xrange(num_lines)]
+            fh.seek(pos)
+            return filter(None, sample)
+        name, format = _cached_detect(st, lines, cache_file=cache_file)
+    else:
+        sample = list(islice(fh, num_lines))
+        name, format = detect_parser(sample)
+        fh = chain(sample, fh)
+        
+    logging.info("Detected log format: %s %s", name, format or '')
+    return get_parser(name, format=format), fh
+
+
+def detect_file_parser(filename, num_lines=100, cache_file=None):
+    """Detect log format of given file and return a parser instance for it"""
+    st = os.stat(filename)
+    def lines():
+        with open_input(filename) as fh:
+            return list(islice(fh, num_lines))
+    name, format = _cached_detect(st, lines, cache_file=cache_file)
+    return get_parser(name, format=format)
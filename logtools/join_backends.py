@@ -44,12 +44,26 @@ class JoinBackend(object):
     def join(self, rows):
         """Implement a join generator"""
         
+    def join_many(self, keys):
+        """Join a batch of keys. Returns dictionary mapping
+        each key to a list of its joined rows. Backends can override 
+        this to fetch the whole batch at once"""
+        joined = {}
+        for key in keys:
+            if key not in joined:
+                joined[key] = list(self.join(key))
+        return joined
+        
         
 class SQLAlchemyJoinBackend(JoinBackend):
     """sqlalchemy-based join backend,
     allowing for arbitrary DB's based on a
     connection URL"""
     
+    # Maximum number of keys joined by a single query (sqlite 
+    # limits compound SELECT statements to 500 terms by default)
+    MAX_BATCH_KEYS = 250
+    
     def __init__(self, remote_fields, remote_name, 
                  remote_key, connect_string):
         """Initialize db connection"""
@@ -71,6 +85,26 @@ class SQLAlchemyJoinBackend(JoinBackend):
         rp = self.db.bind.execute(self.query_stmt, key=key)
         for row in rp.fetchall():
             yield row # dict(zip(field_names, row))
+            
+    def join_many(self, keys):
+        """Join a batch of keys using a single query, a 'UNION ALL' of
+        per-key lookups (see _create_batch_query_stmt). Each lookup
+        compares the remote key exactly as join() does, and selects its
+        bound key, so rows are matched back to the key that joined them.
+        A 'WHERE <key> IN (...)' query can't be used here: it returns the
+        remote key rather than the input key, which may differ through type
+        conversion or collation (e.g '007' joining an INTEGER 7), and a remote 
+        row only once even if several input keys match it"""
+        keys = list(set(keys))
+        joined = dict((unicode(key), []) for key in keys)
+        for start in xrange(0, len(keys), self.MAX_BATCH_KEYS):
+            batch = keys[start:start+self.MAX_BATCH_KEYS]
+            params = dict(('key%d' % i, key) for i, key in enumerate(batch))
+            rp = self.db.bind.execute(self._create_batch_query_stmt(len(batch)), **params)
+            for row in rp.fetchall():
+                # Bound key is selected last
+                joined[unicode(row[-1])].append(tuple(row)[:-1])
+        return joined
                 
                 
     def _create_query_stmt(self):
@@ -87,3 +121,14 @@ class SQLAlchemyJoinBackend(JoinBackend):
                                         self.remote_name, self.remote_key)
         
         return query_stmt
+    
+    def _create_batch_query_stmt(self, num_keys):
+        """Create query statement string for joining a batch
+        of num_keys keys, selecting the bound key as last field"""
+        if self.connect_string.startswith("sqlite"):
+            placeholders = [":key%d" % i for i in xrange(num_keys)]
+        else:
+            placeholders = ["%(key{0})s".format(i) for i in xrange(num_keys)]
+        return " UNION ALL ".join(["""SELECT {0}, {3} FROM {1} WHERE {2} = {3}""".format(
+                                    self.remote_fields, self.remote_name, self.remote_key, 
+                                    placeholder) for placeholder in placeholders])
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+logtools.parallel
+Line filtering loop shared by the filtering tools (logfilter, filterbots),
+and a multi-process variant of it for regular files. The file is split
+into newline-aligned chunks which are filtered by a pool of worker
+processes, emitting the results in original order.
+"""
+import os
+import stat
+import mmap
+import logging
+from collections import deque
+from multiprocessing import Pool
+
+__all__ = ['filter_lines', 'parallel_filter_lines', 'is_regular_file',
+           'chunk_offsets']
+
+# Size of chunks handed out to worker processes
+CHUNK_SIZE = 32 * 1024 * 1024
+
+# State inherited by forked worker processes (see parallel_filter_lines)
+_predicate = None
+_reverse = False
+_stats = None
+_mmap = None
+
+
+def filter_lines(lines, predicate, reverse=False, counts=None):
+    """Yield (stripped) lines for which predicate is false, or true
+    when reverse is set. Lines for which predicate raises KeyError/ValueError
+    (parsing errors) are skipped. Number of emitted, filtered and unmatched
+    lines are accumulated into the 'lines', 'filtered', 'nomatch' keys of
+    the counts dictionary, if given"""
+    if counts is None:
+        counts = {}
+    for key in ('lines', 'filtered', 'nomatch'):
+        counts.setdefault(key, 0)
+
+    for line in lines:
+        line = line.strip()
+        try:
+            matched = predicate(line)
+        except (KeyError, ValueError):
+            # Parsing error
+            logging.warn("No match for line: %s", line)
+            counts['nomatch'] += 1
+            continue
+
+        if matched ^ reverse:
+            logging.debug("Filtering line: %s", line)
+            counts['filtered'] += 1
+            continue
+
+        counts['lines'] += 1
+        yield line
+
+
+def is_regular_file(fh):
+    """Check whether file object is backed by a regular file"""
+    try:
+        return stat.S_ISREG(os.fstat(fh.fileno()).st_mode)
+    except (AttributeError, ValueError, IOError, OSError):
+        return False
+
+
+def chunk_offsets(mm, start, end, chunk_size=CHUNK_SIZE):
+    """Split byte range [start, end) of a memory-mapped file into
+    chunks ending on line boundaries. Yields (start, end) offsets"""
+    while start < end:
+        pos = mm.find('\n', min(start + chunk_size, end) - 1, end)
+        if pos == -1:
+            pos = end
+        else:
+            pos += 1
+        yield start, pos
+        start = pos
+
+
+def _filter_chunk(chunk):
+    """Filter lines of given chunk of the (inherited) memory-mapped
+    file. Returns the emitted lines and the counts"""
+    start, end = chunk
+    counts = {}
+    stats = _stats and _stats() or {}
+    lines = _mmap[start:end].split('\n')
+    if not lines[-1]:
+        lines.pop()
+    output = list(filter_lines(lines, _predicate, reverse=_reverse, counts=counts))
+    if _stats:
+        for key, value in _stats().iteritems():
+            counts[key] = value - stats.get(key, 0)
+    return output, counts
+
+
+def parallel_filter_lines(fh, predicate, reverse=False, counts=None, jobs=2, stats=None):
+    """Multi-process variant of filter_lines, for regular files.
+    Input is read from the current position of fh to its end, in chunks
+    filtered by a pool of worker processes. The predicate is inherited
+    (rather than pickled) by the forked workers, so any automatons/regular
+    expressions it holds are built only once, by the calling process.
+    If given, stats() should return a dictionary of (monotonic) counters
+    kept by the predicate, e.g cache hits. These are summed up across
+    workers into counts"""
+    global _predicate, _reverse, _stats, _mmap
+
+    if counts is None:
+        counts = {}
+    for key in ('lines', 'filtered', 'nomatch'):
+        counts.setdefault(key, 0)
+
+    start, end = fh.tell(), os.fstat(fh.fileno()).st_size
+    if start >= end:
+        return
+
+    _predicate, _reverse, _stats = predicate, reverse, stats
+    _mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    pool = Pool(jobs)
+    try:
+        chunk_size = max(min(CHUNK_SIZE, (end - start) // (jobs * 4)), 1)
+        chunks = chunk_offsets(_mmap, start, end, chunk_size=chunk_size)
+
+        # Keep a bounded number of chunks in flight, and
+        # emit results in original order
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_filter_chunk, (chunk,)))
+            while pending and (len(pending) >= jobs * 2 or pending[0].ready()):
+                output, chunk_counts = pending.popleft().get()
+                for key, value in chunk_counts.iteritems():
+                    counts[key] = counts.get(key, 0) + value
+                for line in output:
+                    yield line
+
+        while pending:
+            output, chunk_counts = pending.popleft().get()
+            for key, value in chunk_counts.iteritems():
+                counts[key] = counts.get(key, 0) + value
+            for line in output:
+                yield line
+    finally:
+        pool.terminate()
+        pool.join()
+        _mmap.close()
+        _predicate, _stats, _mmap = None, None, None
+        fh.seek(end)
@@ -23,14 +23,46 @@ import re
 import sys
 import logging
 from functools import partial
+from itertools import izip, imap
 from datetime import datetime
 from abc import ABCMeta, abstractmethod
 import json
 
 from _config import AttrDict
+from logtools.timestamps import get_timestamp_parser, clf_epoch, CLF_DATE_FORMAT
 
 __all__ = ['multikey_getter_gen', 'unescape_json', 'LogParser', 'JSONParser', 'LogLine',
-           'AccessLog', 'CommonLogFormat', 'uWSGIParser']
+           'AccessLog', 'CommonLogFormat', 'uWSGIParser', 'register_parser', 'get_parser']
+
+# Entry point group used for discovering parser plugins
+PARSERS_ENTRY_POINT = 'logtools.parsers'
+
+# Registered parser classes, by name
+_parsers = {}
+_plugins_loaded = False
+
+# Compiled AccessLog formats, by (parser class, format, fields)
+_format_cache = {}
+
+
+_parse_clf_date = get_timestamp_parser(CLF_DATE_FORMAT)
+_parse_uwsgi_date = get_timestamp_parser('%a %b %d %H:%M:%S %Y')
+
+
+def _to_number(value):
+    """Convert to int, or float if value is fractional"""
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _bytes_to_int(value):
+    """Convert a response size (e.g %b) to int. 
+    '-' is used for responses with no content"""
+    if value == '-':
+        return 0
+    return int(value)
 
 
 def multikey_getter_gen(parser, keys, is_indices=False, delimiter="\t"):
@@ -65,6 +97,11 @@ def unescape_json(s):
 class LogParser(object):
     """Base class for all our parsers"""
     __metaclass__ = ABCMeta
+    
+    # NumPy dtypes used by parse_many() for typed fields.
+    # Fields not listed here are returned as object arrays,
+    # unless all their values are numbers.
+    column_types = {}
 
     def __call__(self, line):
         """Callable interface"""
@@ -74,26 +111,96 @@ class LogParser(object):
     def parse(self, line):
         """Parse a logline"""
         
+    def parse_many(self, lines, fields=None):
+        """Parse a block of lines into per-field columns.
+        Returns a dictionary of field name -> NumPy array.
+        If fields is not given, the fields of the first
+        parsed line are used. Missing values are None"""
+        rows = []
+        for line in lines:
+            data = self.parse(line)
+            if fields is None:
+                fields = data.keys()
+            rows.append(tuple(data.get(f) for f in fields))
+        return self._columns(fields or [], rows, fields)
+        
+    def _columns(self, keys, rows, fields=None):
+        """Transpose rows of values (ordered as keys) into
+        NumPy arrays for each of the requested fields"""
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("NumPy Python package must be installed to use parse_many()")
+        
+        if fields is None:
+            fields = keys
+        index = dict((k, i) for i, k in enumerate(keys))
+        columns = zip(*rows) or [()] * len(keys)
+        
+        arrays = {}
+        for field in fields:
+            values = columns[index[field]]
+            dtype = self.column_types.get(field, None)
+            if dtype is None:
+                if values and all(isinstance(v, (int, long, float)) and \
+                                  not isinstance(v, bool) for v in values):
+                    arrays[field] = numpy.array(values)
+                else:
+                    arrays[field] = numpy.array(values, dtype=object)
+            elif dtype.startswith('datetime64'):
+                arrays[field] = numpy.array(map(self._decode_date, values), 
+                                            dtype=dtype)
+            else:
+                values = numpy.array(values)
+                if values.dtype.kind in 'SU':
+                    # '-' is used for missing values (e.g %b)
+                    values[values == '-'] = '0'
+                arrays[field] = values.astype(dtype)
+        return arrays
+    
+    def _decode_date(self, value):
+        """Decode a date field value into a datetime,
+        for date columns in parse_many()"""
+        return value
+        
     def set_format(self, format):
         """Set a format specifier for parser.
         Some parsers can use this to specify
         a format string"""
+
+    def set_fields(self, fields):
+        """Restrict parsing to a subset of fields (projection).
+        Parsers supporting this will only extract and store
+        the given fields, skipping the rest of the logline"""
         
         
-class LogLine(dict):
-    """Instrumented dictionary that allows
+class LogLine(object):
+    """Compact record that allows
     convenient access to a parsed log lines,
-    using key-based lookup / index-based / raw / parsed"""
+    using key-based lookup / index-based / raw / parsed.
+    
+    The name -> index mapping is built once per format,
+    and each input line's values (e.g match.groups())
+    are wrapped as-is without being copied"""
     
-    def __init__(self, fieldnames=None):
+    __slots__ = ('_fieldnames', '_keys', '_index', '_values')
+    
+    def __init__(self, fieldnames=None, keys=None):
         """Initialize logline. This class can be reused
-        across multiple input lines by using the clear()
-        method after each invocation"""
+        across multiple input lines by using the wrap()
+        method with each new line's values. keys are the
+        names of the wrapped values, when only a subset 
+        of fieldnames is extracted (defaults to fieldnames)"""
         
-        self._fieldnames = None
+        self._fieldnames = ()
+        self._keys = ()
+        self._index = {}
+        self._values = ()
         
         if fieldnames:
             self.fieldnames = fieldnames
+        if keys is not None:
+            self.set_keys(keys)
             
     @property
     def fieldnames(self):
@@ -103,10 +210,58 @@ class LogLine(dict):
     @fieldnames.setter
     def fieldnames(self, fieldnames):
         """Set the log format field names"""
-        self._fieldnames = dict(enumerate(fieldnames))
+        self._fieldnames = tuple(fieldnames)
+        self.set_keys(self._fieldnames)
+        
+    def set_keys(self, keys):
+        """Set the names of the wrapped field values"""
+        self._keys = tuple(keys)
+        self._index = dict((k, i) for i, k in enumerate(self._keys))
+        
+    def wrap(self, values):
+        """Wrap a sequence of field values, ordered as the keys"""
+        self._values = values
+        return self
+        
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+    
+    def __contains__(self, key):
+        return key in self._index
+    
+    def __iter__(self):
+        return iter(self._keys)
+    
+    def __len__(self):
+        return len(self._keys)
+    
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+        
+    def keys(self):
+        return list(self._keys)
+    
+    def values(self):
+        return list(self._values)
+    
+    def items(self):
+        return zip(self._keys, self._values)
+    
+    def iteritems(self):
+        return izip(self._keys, self._values)
         
     def by_index(self, i, raw=False):
-        return self.by_key(self._fieldnames[i], raw=raw)
+        try:
+            key = self._fieldnames[i]
+        except (IndexError, TypeError):
+            raise KeyError(i)
+        return self.by_key(key, raw=raw)
     
     def by_key(self, key, raw=False):
         """Return the i-th field parsed"""
@@ -115,58 +270,186 @@ class LogLine(dict):
         if raw is True:
             return self[key]
         
-        if key == '%t':
-            val = datetime.strptime(self[key][1:-7], '%d/%b/%Y:%H:%M:%S')
-        else:
-            val = self[key]
+        val = self[key]
+        if key == '%t' and isinstance(val, basestring):
+            val = _parse_clf_date(val[1:-7])
         return val
         
 
+def _get_path(obj, path):
+    """Lookup a nested value by a sequence of keys.
+    Numeric keys can be used to index into lists.
+    Raises KeyError if the path can't be followed"""
+    for k in path:
+        if isinstance(obj, list):
+            try:
+                obj = obj[int(k)]
+            except (ValueError, IndexError):
+                raise KeyError(k)
+        else:
+            try:
+                obj = obj[k]
+            except TypeError:
+                # Null or scalar value along the path
+                raise KeyError(k)
+    return obj
+
+def _field_paths(fields):
+    """Map field names into (field, path) tuples for _get_field.
+    Path is None for field names which are not dot-separated"""
+    return [(f, '.' in f and tuple(f.split('.')) or None) for f in fields]
+
+def _get_field(obj, field, path):
+    """Lookup field by its (flat) key, falling back 
+    to a nested lookup by its dot-separated path"""
+    try:
+        return obj[field]
+    except (KeyError, TypeError):
+        if path is None:
+            raise KeyError(field)
+    return _get_path(obj, path)
+    
+
 class JSONParser(LogParser):
-    """Parser implementation for JSON format logs"""
+    """Parser implementation for JSON format logs.
+    Only the given fields are extracted if specified. Fields not
+    found as (flat) keys are looked up as dot-separated paths of
+    nested keys (e.g 'request.path').
+    A custom JSON decoder can be given as a callable, or as the
+    name of a module providing a loads() function (e.g 'ujson')"""
     
-    def __init__(self):
+    def __init__(self, fields=None, decoder=None):
         LogParser.__init__(self)
         self._logline_wrapper = LogLine()
+        self._keys = None
+        self._paths = None
+        self.set_decoder(decoder)
+        self.set_fields(fields)
+        
+    def set_decoder(self, decoder):
+        """Set the JSON decoding function"""
+        if decoder is None:
+            decoder = json.loads
+        elif isinstance(decoder, basestring):
+            decoder = __import__(decoder, {}, {}, ['loads']).loads
+        self._decode = decoder
+        
+    def set_fields(self, fields):
+        """Only extract the given (possibly nested) fields"""
+        self.fields = fields
+        self._keys = None
+        self._paths = None
+        if fields is not None:
+            self._paths = _field_paths(fields)
+            self._logline_wrapper.fieldnames = fields
         
     def parse(self, line):
         """Parse JSON line"""
-        parsed_row = json.loads(line)
+        parsed_row = self._decode(line)
         
         data = self._logline_wrapper
+        
+        if self._paths is not None:
+            return data.wrap([_get_field(parsed_row, field, path) \
+                              for field, path in self._paths])
 
-        # This is called for every log line - This is because
         # JSON logs are generally schema-less and so fields
-        # can change between lines.
-        self._logline_wrapper.fieldnames = parsed_row.keys()
+        # can change between lines. Field mapping is only
+        # rebuilt when the set of keys changes.
+        keys = parsed_row.keys()
+        if keys != self._keys:
+            self._keys = keys
+            data.fieldnames = keys
+
+        return data.wrap(parsed_row.values())
+    
+    def parse_many(self, lines, fields=None):
+        """Parse a block of JSON lines into per-field columns.
+        Nested fields can be given as dot-separated paths"""
+        if fields is None:
+            return LogParser.parse_many(self, lines)
+        
+        def _get(obj, field, path):
+            try:
+                return _get_field(obj, field, path)
+            except KeyError:
+                return None
             
-        data.clear()
-        for k, v in parsed_row.iteritems():
-            data[k] = v
-
-        return data
+        decode = self._decode
+        paths = _field_paths(fields)
+        rows = [tuple(_get(obj, field, path) for field, path in paths) \
+                for obj in imap(decode, lines)]
+        return self._columns(fields, rows)
     
 
 class AccessLog(LogParser):
     """Apache access_log logfile parser. This can
     consume arbitrary Apache log field directives. see
-    http://httpd.apache.org/docs/1.3/logs.html#accesslog"""
-
-    def __init__(self, format=None):
+    http://httpd.apache.org/docs/1.3/logs.html#accesslog
+    
+    In typed mode, field values are converted to native
+    types according to their directive (see field_types)"""
+    
+    # Conversions applied to field values in typed mode
+    field_types = {
+        '%>s': int,
+        '%s':  int,
+        '%b':  _bytes_to_int,
+        '%B':  int,
+        '%D':  _to_number,
+        '%T':  _to_number,
+        '%t':  clf_epoch
+    }
+    
+    column_types = {
+        '%>s': 'int64',
+        '%s':  'int64',
+        '%b':  'int64',
+        '%B':  'int64',
+        '%D':  'int64',
+        '%T':  'float64',
+        '%t':  'datetime64[s]'
+    }
+
+    def __init__(self, format=None, fields=None, typed=False):
         LogParser.__init__(self)
         
+        self.format        = None
+        self.fields        = fields
+        self.typed         = typed
         self.fieldnames    = None
         self.fieldselector = None
         self._logline_wrapper = None
         
         if format:
-            self.fieldselector = self._parse_log_format(format)
-            self._logline_wrapper = LogLine(self.fieldnames)     
+            self.set_format(format)
 
     def set_format(self, format):
-        """Set the access_log format"""
-        self.fieldselector = self._parse_log_format(format)
-        self._logline_wrapper = LogLine(self.fieldnames)     
+        """Set the access_log format. Compiled formats are
+        cached and shared across instances of the same parser class,
+        as subclasses may compile formats differently"""
+        self.format = format
+        key = (type(self), format, None if self.fields is None else tuple(self.fields))
+        try:
+            self.fieldselector, fieldnames, captured = _format_cache[key]
+            self.fieldnames, self._captured = list(fieldnames), list(captured)
+        except KeyError:
+            self.fieldselector = self._parse_log_format(format, self.fields)
+            _format_cache[key] = (self.fieldselector, tuple(self.fieldnames), 
+                                  tuple(self._captured))
+        self._logline_wrapper = LogLine(self.fieldnames, keys=self._captured)
+        
+        # (index, converter) of typed fields, in captured values
+        self._converters = [(i, self.field_types[k]) for i, k in \
+                            enumerate(self._captured) if k in self.field_types]
+
+    def set_fields(self, fields):
+        """Only capture the given field directives (e.g ['%h', '%>s']).
+        Directives not listed are matched but not extracted. Use
+        None to go back to parsing all fields"""
+        self.fields = fields
+        if self.format:
+            self.set_format(self.format)
         
     def parse(self, logline):
         """
@@ -181,18 +464,51 @@ class AccessLog(LogParser):
                     self.__class__.__name__ )
 
         if match:
-            data = self._logline_wrapper
-            data.clear()
-            for k, v in zip(self.fieldnames, match.groups()):
-                data[k] = v
-            return data                
+            if self.typed:
+                return self._logline_wrapper.wrap(self._convert(match.groups()))
+            return self._logline_wrapper.wrap(match.groups())
         else:
             raise ValueError("Could not parse log line: '%s'" % logline)
-
-    def _parse_log_format(self, format):
+        
+    def parse_many(self, loglines, fields=None):
+        """Parse a block of log lines into per-field columns"""
+        try:
+            match = self.fieldselector.match
+        except AttributeError, exc:
+            raise AttributeError("%s needs a valid format string (--format)" % \
+                    self.__class__.__name__ )
+        
+        rows = []
+        for logline in loglines:
+            m = match(logline)
+            if not m:
+                raise ValueError("Could not parse log line: '%s'" % logline)
+            rows.append(m.groups())
+        if self.typed:
+            rows = map(self._convert, rows)
+        return self._columns(self._captured, rows, fields)
+    
+    def _convert(self, values):
+        """Convert typed field values to native types"""
+        values = list(values)
+        for i, converter in self._converters:
+            values[i] = converter(values[i])
+        return values
+    
+    def _decode_date(self, value):
+        """Decode %t values into (UTC) epoch seconds, applying
+        their timezone offset, same as in typed mode"""
+        if not isinstance(value, basestring):
+            # Epoch seconds (typed mode)
+            return value
+        return clf_epoch(value)
+
+    def _parse_log_format(self, format, fields=None):
         """This code piece is based on the apachelogs 
         python/perl projects. Raises an exception if 
-        it couldn't compile the generated regex"""
+        it couldn't compile the generated regex.
+        When fields is given, only these directives
+        are captured by the generated regex"""
         format = format.strip()
         format = re.sub('[ \t]+',' ',format)
 
@@ -204,6 +520,7 @@ class AccessLog(LogParser):
         lstripquotes = re.compile(r'^"')
         rstripquotes = re.compile(r'"$')
         self.fieldnames = []
+        self._captured = []
 
         for element in format.split(' '):
             hasquotes = 0
@@ -216,19 +533,30 @@ class AccessLog(LogParser):
 
             self.fieldnames.append(element)
 
-            subpattern = '(\S*)'
+            subpattern = r'\S*'
 
             if hasquotes:
                 if element == '%r' or findreferreragent.search(element):
-                    subpattern = r'\"([^"\\]*(?:\\.[^"\\]*)*)\"'
+                    subpattern = r'[^"\\]*(?:\\.[^"\\]*)*'
                 else:
-                    subpattern = r'\"([^\"]*)\"'
+                    subpattern = r'[^\"]*'
 
             elif findpercent.search(element):
-                subpattern = r'(\[[^\]]+\])'
+                subpattern = r'\[[^\]]+\]'
 
             elif element == '%U':
-                subpattern = '(.+?)'
+                subpattern = '.+?'
+
+            if fields is None or element in fields:
+                # Capture field
+                self._captured.append(element)
+                subpattern = '(' + subpattern + ')'
+            else:
+                # Match but skip field
+                subpattern = '(?:' + subpattern + ')'
+
+            if hasquotes:
+                subpattern = r'\"' + subpattern + r'\"'
 
             subpatterns.append(subpattern)
 
@@ -245,27 +573,117 @@ class CommonLogFormat(AccessLog):
     See http://httpd.apache.org/docs/1.3/logs.html#accesslog
     """
 
-    def __init__(self):
-        AccessLog.__init__(self, format='%h %l %u %t "%r" %>s %b')
+    def __init__(self, fields=None, typed=False):
+        AccessLog.__init__(self, format='%h %l %u %t "%r" %>s %b', 
+                           fields=fields, typed=typed)
+
+
+def _split_uwsgi_line(logline):
+    """Split a uWSGI request log line into its
+    ip, timestamp, method, path, bytes and processing_time fields.
+    Scans the line left to right using fixed tokens of the uWSGI
+    log layout, e.g:
+    [pid: 1|app: 0|req: 2/3] <ip> (<user>) {<n> vars in <n> bytes} [<date>] <method> <path> => generated <n> bytes in <n> msecs ...
+    Raises ValueError if line does not match the layout"""
+    # Remote address, following the '[pid: ...]' header
+    start = logline.index('] ') + 2
+    end = logline.index(' ', start)
+    ip = logline[start:end]
+    
+    # Request time, following the '{... vars in ... bytes}' block
+    start = logline.index('} [', end) + 3
+    end = logline.index('] ', start)
+    timestamp = logline[start:end]
+    
+    # Request line
+    start = end + 2
+    end = logline.index(' => generated ', start)
+    method, path = logline[start:end].split(' ')
+    
+    # Response size and time
+    nbytes, _bytes, _in, msecs, rest = logline[end+14:].split(' ', 4)
+    if not (method.isalpha() and method.isupper() and nbytes.isdigit() and msecs.isdigit() \
+            and _bytes == 'bytes' and _in == 'in' and rest.startswith('msecs ')):
+        raise ValueError("Could not parse log line: '%s'" % logline)
+    
+    return ip, timestamp, method, path, nbytes, msecs
 
 
 class uWSGIParser(LogParser):
     """Parser for the uWSGI log format"""
+    
+    column_types = {
+        'bytes': 'int64',
+        'processing_time': 'int64',
+        'timestamp': 'datetime64[s]'
+    }
 
     def __init__(self):
         LogParser.__init__(self)
-        self._re = re.compile(r'.* ((?:[0-9]+\.){3}[0-9]+) .* \[(.*?)\] (GET|POST) (\S+) .* generated (\d+) bytes in (\d+) msecs .*')
         self.fieldnames = ('ip', 'timestamp', 'method', 'path', 'bytes', 'processing_time')
         self._logline_wrapper = LogLine(self.fieldnames)
 
     def parse(self, logline):
         """Parse log line"""
-        match = self._re.match(logline)
-        if match:
-            data = self._logline_wrapper
-            data.clear()
-            for k, v in zip(self.fieldnames, match.groups()):
-                data[k] = v
-            return data
-        else:
+        try:
+            return self._logline_wrapper.wrap(_split_uwsgi_line(logline))
+        except ValueError:
             raise ValueError("Could not parse log line: '%s'" % logline)
+        
+    def parse_many(self, loglines, fields=None):
+        """Parse a block of log lines into per-field columns"""
+        rows = []
+        for logline in loglines:
+            try:
+                rows.append(_split_uwsgi_line(logline))
+            except ValueError:
+                raise ValueError("Could not parse log line: '%s'" % logline)
+        return self._columns(self.fieldnames, rows, fields)
+    
+    def _decode_date(self, value):
+        return _parse_uwsgi_date(value)
+
+
+def register_parser(cls, name=None):
+    """Register a parser class, for lookup by name
+    (defaults to the class name) using get_parser()"""
+    _parsers[name or cls.__name__] = cls
+    return cls
+
+
+def _load_plugins():
+    """Register parser plugins from installed packages,
+    declared under the 'logtools.parsers' entry point group"""
+    global _plugins_loaded
+    _plugins_loaded = True
+    try:
+        from pkg_resources import iter_entry_points
+    except ImportError:
+        return
+    for entry_point in iter_entry_points(PARSERS_ENTRY_POINT):
+        try:
+            register_parser(entry_point.load(), entry_point.name)
+        except ImportError, exc:
+            logging.warn("Could not load parser plugin '%s': %s", entry_point.name, exc)
+
+
+def get_parser(name, format=None, **kwargs):
+    """Return a parser instance by registered name
+    (e.g 'CommonLogFormat'), using given format string
+    if specified. Extra arguments are passed on to the
+    parser class constructor"""
+    if name not in _parsers and not _plugins_loaded:
+        _load_plugins()
+    try:
+        cls = _parsers[name]
+    except KeyError:
+        raise ValueError("Unknown parser: '%s'. Available parsers: %s" % \
+                         (name, ', '.join(sorted(_parsers))))
+    parser = cls(**kwargs)
+    if format:
+        parser.set_format(format)
+    return parser
+
+
+for _cls in (JSONParser, AccessLog, CommonLogFormat, uWSGIParser):
+    register_parser(_cls)
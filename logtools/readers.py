@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+logtools.readers
+Input layer shared by the tools. Inputs compressed with gzip, bz2, 
+xz or zstd (detected by their magic bytes) are transparently decompressed
+by a background thread, with read-ahead buffering, so that decompression
+overlaps parsing. Bulk line readers read input in large blocks
+(memory-mapped for regular files) and split them into batches of lines, 
+so that per-line work is done by a few calls over whole batches rather
+than by iterating the file object line by line.
+"""
+import os
+import sys
+import bz2
+import time
+import mmap
+import zlib
+import logging
+import threading
+from Queue import Queue, Empty, Full
+from cStringIO import StringIO
+from functools import partial
+from itertools import islice, chain
+
+from logtools.parallel import is_regular_file
+
+__all__ = ['open_input', 'open_inputs', 'InputReader', 'detect_compression',
+           'line_batches', 'keyed_batches', 'prefetch', 'timed_batches', 'READ_SIZE']
+
+# Size of blocks read at a time
+READ_SIZE = 1024 * 1024
+
+# Size of compressed blocks read at a time. Kept smaller,
+# as blocks can expand by an order of magnitude
+COMPRESSED_READ_SIZE = 256 * 1024
+
+# Number of (decompressed) blocks buffered ahead of the reader
+READ_AHEAD = 4
+
+# Compression formats, by magic bytes
+_COMPRESSION_MAGIC = [
+    ('\x1f\x8b', 'gzip'),
+    ('BZh', 'bz2'),
+    ('\xfd7zXZ\x00', 'xz'),
+    ('\x28\xb5\x2f\xfd', 'zstd'),
+]
+_MAX_MAGIC_LEN = 6
+
+# Number of lines per batch, when reading from a plain iterable of lines
+BATCH_LINES = 8192
+
+
+def detect_compression(data):
+    """Detect compression format ('gzip', 'bz2', 'xz', 'zstd')
+    from leading bytes of input. Returns None for uncompressed input"""
+    for magic, name in _COMPRESSION_MAGIC:
+        if data.startswith(magic):
+            if name == 'bz2' and data[3:4] not in '123456789':
+                # Block size digit, plain text may well start with 'BZh'
+                continue
+            return name
+    return None
+
+
+def _decompressor_factory(compression):
+    """Return function creating decompressor objects
+    (with a decompress() method) for given compression format"""
+    if compression == 'gzip':
+        return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Decompressor
+    elif compression == 'xz':
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise IOError("lzma (backports.lzma) Python package must be installed to read xz-compressed input")
+        return lzma.LZMADecompressor
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise IOError("zstandard Python package must be installed to read zstd-compressed input")
+        return zstandard.ZstdDecompressor().decompressobj
+    raise ValueError("Unknown compression format: '%s'" % compression)
+
+
+def _open_stream(source):
+    """Open input file (name or file object), detecting its compression.
+    Returns (file object, raw read function, already read leading data,
+    compression format)"""
+    if isinstance(source, basestring):
+        fh = open(source, 'rb')
+    else:
+        fh = source
+
+    if is_regular_file(fh):
+        pos = fh.tell()
+        compression = detect_compression(fh.read(_MAX_MAGIC_LEN))
+        fh.seek(pos)
+        read_size = compression and COMPRESSED_READ_SIZE or READ_SIZE
+        return fh, partial(fh.read, read_size), '', compression
+
+    try:
+        # Pipes, sockets: return data as soon as it is available
+        read = partial(os.read, fh.fileno(), READ_SIZE)
+    except (AttributeError, ValueError, IOError):
+        read = partial(fh.read, READ_SIZE)
+    head = ''
+    while len(head) < _MAX_MAGIC_LEN:
+        data = read()
+        if not data:
+            break
+        head += data
+    return fh, read, head, detect_compression(head)
+
+
+def open_input(source, read_ahead=READ_AHEAD):
+    """Open input file (name or file object) for reading, transparently
+    decompressing it if compressed. Uncompressed regular files are returned
+    as plain file objects. Other inputs are read (and decompressed) by a
+    background thread, see InputReader"""
+    fh, read, head, compression = _open_stream(source)
+    if compression is None and is_regular_file(fh):
+        return fh
+    return InputReader([(fh, read, head, compression)], read_ahead=read_ahead)
+
+
+def open_inputs(filenames, read_ahead=READ_AHEAD):
+    """Open input files for reading as a single, concatenated stream
+    (see open_input). With no filenames, or '-', standard input is read"""
+    sources = [filename != '-' and filename or sys.stdin 
+               for filename in filenames or ['-']]
+    if len(sources) == 1:
+        return open_input(sources[0], read_ahead=read_ahead)
+    return InputReader([_open_stream(source) for source in sources], 
+                       read_ahead=read_ahead)
+
+
+class InputReader(object):
+    """Read-only file-like object over one or more (possibly compressed)
+    input streams, which are read and decompressed by a background thread 
+    into a bounded queue of blocks. Supports iteration over lines, 
+    readline() and read(); Like with regular file objects, iteration
+    should not be mixed with the other methods. read(size) may return
+    fewer bytes than requested, returning '' only at end of input"""
+
+    def __init__(self, streams, read_ahead=READ_AHEAD):
+        self.name = streams and getattr(streams[0][0], 'name', '<input>') or '<input>'
+        self._streams = streams
+        self._buffer = ''
+        self._offset = 0
+        self._eof = False
+        self._lines = None
+        self._queue = Queue(maxsize=read_ahead)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._read_ahead, name="read:%s" % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        """Put item into queue, unless (or until) input is closed.
+        Blocking puts time out, so that the reader thread never stays
+        blocked on a full queue once the consumer stops"""
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _read_ahead(self):
+        """Read (and decompress) input streams into queue. Errors are 
+        passed through the queue, followed by an end of input marker"""
+        put = self._put
+        try:
+            for fh, read, data, compression in self._streams:
+                factory = compression and _decompressor_factory(compression)
+                decompressor = factory and factory()
+                data = data or read()
+                while data and not self._closed.is_set():
+                    if decompressor is None:
+                        put(data)
+                    while decompressor is not None and data:
+                        try:
+                            block = decompressor.decompress(data)
+                        except EOFError:
+                            # Stream ended on previous block, start next
+                            # (concatenated) one
+                            decompressor = factory()
+                            continue
+                        if block:
+                            put(block)
+                        data = getattr(decompressor, 'unused_data', '')
+                        if data:
+                            # Concatenated streams, e.g multi-member gzip
+                            decompressor = factory()
+                    data = read()
+                if hasattr(decompressor, 'flush'):
+                    put(decompressor.flush())
+        except Exception, exc:
+            if self._closed.is_set():
+                # Input closed while reading
+                return
+            put(IOError("Could not read %s: %s" % (self.name, exc)))
+        put(None)
+
+    def _next_block(self):
+        """Return next block of data, or '' at end of input"""
+        while not self._eof:
+            block = self._queue.get()
+            if block is None:
+                self._eof = True
+            elif isinstance(block, Exception):
+                self._eof = True
+                raise block
+            elif block:
+                return block
+        return ''
+
+    def _line_blocks(self):
+        """Yield file-like objects over blocks of whole lines"""
+        pending = self._buffer[self._offset:]
+        self._buffer, self._offset = '', 0
+        while True:
+            block = self._next_block()
+            if not block:
+                break
+            end = block.rfind('\n') + 1
+            if not end:
+                pending += block
+                continue
+            yield StringIO(pending + block[:end])
+            pending = block[end:]
+        if pending:
+            yield StringIO(pending)
+
+    def __iter__(self):
+        if self._lines is None:
+            self._lines = chain.from_iterable(self._line_blocks())
+        return self._lines
+
+    def read(self, size=-1):
+        if size < 0:
+            data = [self._buffer[self._offset:]]
+            self._buffer, self._offset = '', 0
+            block = self._next_block()
+            while block:
+                data.append(block)
+                block = self._next_block()
+            return ''.join(data)
+        if self._offset >= len(self._buffer):
+            self._buffer, self._offset = self._next_block(), 0
+        data = self._buffer[self._offset:self._offset+size]
+        self._offset += len(data)
+        return data
+
+    def readline(self):
+        parts = []
+        while True:
+            if self._offset >= len(self._buffer):
+                self._buffer, self._offset = self._next_block(), 0
+                if not self._buffer:
+                    break
+            end = self._buffer.find('\n', self._offset)
+            if end >= 0:
+                parts.append(self._buffer[self._offset:end+1])
+                self._offset = end + 1
+                break
+            parts.append(self._buffer[self._offset:])
+            self._offset = len(self._buffer)
+        return ''.join(parts)
+
+    def close(self):
+        """Stop reading ahead, and close input files"""
+        self._closed.set()
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Empty:
+            pass
+        for fh, read, data, compression in self._streams:
+            if fh is not sys.stdin:
+                fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _blocks(fh, read_size):
+    """Yield blocks of data read from fh, from its current position"""
+    if is_regular_file(fh):
+        try:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError), exc:
+            # E.g empty file
+            logging.debug("Could not memory-map %s: %s", getattr(fh, 'name', fh), exc)
+        else:
+            try:
+                start = fh.tell()
+                for offset in xrange(start, len(mm), read_size):
+                    yield mm[offset:offset+read_size]
+                fh.seek(len(mm))
+            finally:
+                mm.close()
+            return
+    while True:
+        block = fh.read(read_size)
+        if not block:
+            break
+        yield block
+
+
+def line_batches(fh, read_size=READ_SIZE):
+    """Read lines from file object in large blocks, yielding
+    lists of (stripped) lines. Empty input yields nothing.
+    Plain iterables of lines are batched as they are"""
+    if not hasattr(fh, 'read'):
+        while True:
+            batch = [line.strip() for line in islice(fh, BATCH_LINES)]
+            if not batch:
+                break
+            yield batch
+        return
+    
+    pending = ''
+    for block in _blocks(fh, read_size):
+        lines = block.split('\n')
+        lines[0] = pending + lines[0]
+        pending = lines.pop()
+        if lines:
+            yield [line.strip() for line in lines]
+    if pending:
+        yield [pending.strip()]
+
+
+def keyed_batches(fh, key_func, stats=None):
+    """Yield batches of (key, line) tuples read from file object,
+    see line_batches. If stats dictionary is given, number of lines 
+    and time spent reading/keying are accumulated into its 'lines',
+    'seconds' keys"""
+    batches = line_batches(fh)
+    while True:
+        start = stats is not None and time.time()
+        batch = next(batches, None)
+        if batch is None:
+            break
+        keyed = map(key_func, batch)
+        if stats is not None:
+            stats['lines'] = stats.get('lines', 0) + len(keyed)
+            stats['seconds'] = stats.get('seconds', 0) + time.time() - start
+        yield keyed
+
+
+def prefetch(iterable, size=READ_AHEAD, name=None):
+    """Iterate given iterable (e.g of line batches) in a background thread,
+    which keeps up to size items buffered ahead of the consumer, so that
+    I/O latency is hidden. Yields the items. Errors raised by the iterable
+    are re-raised to the consumer"""
+    queue = Queue(maxsize=max(size, 1))
+    stopped = threading.Event()
+
+    def _fill():
+        try:
+            for item in iterable:
+                if stopped.is_set():
+                    return
+                queue.put((True, item))
+        except Exception:
+            if not stopped.is_set():
+                queue.put((False, sys.exc_info()))
+            return
+        if not stopped.is_set():
+            queue.put((False, None))
+
+    thread = threading.Thread(target=_fill, name="prefetch:%s" % (name or iterable))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if ok:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item[0], item[1], item[2]
+    finally:
+        # Unblock producer if consumer stops early
+        stopped.set()
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+
+
+def timed_batches(iterable, batch_size, max_latency=None):
+    """Group items of iterable into lists of up to batch_size items.
+    If max_latency (seconds) is given, a batch is also emitted once its
+    first item has been buffered for that long, even while the iterable
+    blocks (e.g on a slow input stream). Items are then read by a
+    background thread, buffering up to batch_size items"""
+    iterable = iter(iterable)
+    if not max_latency:
+        while True:
+            batch = list(islice(iterable, batch_size))
+            if not batch:
+                break
+            yield batch
+        return
+
+    cond = threading.Condition()
+    state = {'items': [], 'first': None, 'done': False, 'error': None, 'stopped': False}
+
+    def _fill():
+        try:
+            for item in iterable:
+                with cond:
+                    while len(state['items']) >= batch_size and not state['stopped']:
+                        cond.wait()
+                    if state['stopped']:
+                        return
+                    state['items'].append(item)
+                    if len(state['items']) == 1:
+                        state['first'] = time.time()
+                        cond.notify()
+                    elif len(state['items']) >= batch_size:
+                        cond.notify()
+        except Exception:
+            state['error'] = sys.exc_info()
+        with cond:
+            state['done'] = True
+            cond.notify()
+
+    thread = threading.Thread(target=_fill, name="batch:%s" % (iterable,))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            with cond:
+                while True:
+                    items = state['items']
+                    if state['done'] or len(items) >= batch_size or \
+                       (items and time.time() >= state['first'] + max_latency):
+                        break
+                    timeout = None
+                    if items:
+                        timeout = max(state['first'] + max_latency - time.time(), 0.001)
+                    cond.wait(timeout)
+                state['items'] = []
+                cond.notify()
+            if items:
+                yield items
+            elif state['done']:
+                break
+        if state['error'] is not None:
+            error = state['error']
+            raise error[0], error[1], error[2]
+    finally:
+        with cond:
+            state['stopped'] = True
+            cond.notify()
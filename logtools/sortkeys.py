@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+logtools.sortkeys
+Sort key specifications shared by the merging/sorting tools.
+A key function maps a (stripped) line into a (key, line) tuple,
+extracting and converting the key field in a single pass.
+"""
+import logtools.parsers
+from logtools.detect import detect_file_parser
+from logtools.timestamps import get_timestamp_parser
+
+__all__ = ['make_key_func', 'key_func_from_options']
+
+
+def make_key_func(field, delimiter=' ', numeric=False, datetime=False,
+                  dateformat=None, parser=None):
+    """Return function mapping a (stripped) line into a (key, line) tuple.
+    Key is given field of the line (1-based index, or field name when
+    using a parser instance), converted to an integer if numeric is set,
+    or to a datetime using dateformat if datetime is set. Decoded datetimes
+    are memoized per distinct timestamp string"""
+    if numeric:
+        convert = int
+    elif datetime:
+        convert = get_timestamp_parser(dateformat)
+    else:
+        convert = None
+
+    if parser is not None:
+        if str(field).isdigit():
+            index = int(field) - 1
+            extract = lambda line: parser(line).by_index(index)
+        else:
+            parser.set_fields([field])
+            extract = lambda line: parser(line)[field]
+        if convert is None:
+            return lambda line: (extract(line), line)
+        return lambda line: (convert(extract(line)), line)
+
+    # Split only as far as the key field
+    index = int(field) - 1
+    if convert is None:
+        return lambda line: (line.split(delimiter, index + 1)[index], line)
+    return lambda line: (convert(line.split(delimiter, index + 1)[index]), line)
+
+
+def key_func_from_options(options, filenames=None):
+    """Build key function from tool options (field, delimiter, numeric,
+    datetime, dateformat, parser). When parser is 'auto', the log format
+    is detected from the first of given filenames"""
+    parser = options.get('parser', None)
+    if parser == 'auto':
+        # Input files are assumed to share the same format
+        parser = detect_file_parser(filenames[0])
+    elif parser:
+        parser = logtools.parsers.get_parser(parser)
+    else:
+        parser = None
+    return make_key_func(options.field, delimiter=options.get('delimiter', None),
+                         numeric=options.get('numeric', None),
+                         datetime=options.get('datetime', None),
+                         dateformat=options.get('dateformat', None), parser=parser)
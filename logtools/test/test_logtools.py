@@ -14,22 +14,49 @@
 """Unit-test code for logtools"""
 
 import os
+import re
 import sys
+import bz2
+import gzip
+import socket
+import time
+import random
+import shutil
+import sqlite3
 import unittest
 import logging
-from tempfile import mkstemp
+from tempfile import mkstemp, mkdtemp
 from datetime import datetime
 from StringIO import StringIO
 from operator import itemgetter
 
-from logtools import (filterbots, logfilter, geoip, logsample, logsample_weighted, 
-                      logparse, urlparse, logmerge, logplot, qps, sumstat)
+from logtools import (filterbots, logfilter, geoip, logfilter_parse_args, logtail, logtail_parse_args, logsample, logsample_weighted, 
+                      logparse, urlparse, logmerge, logsort, logjoin, logplot, qps, sumstat,
+                      parse_bots_ua, is_bot_ua, compile_bots_ua)
 from logtools.parsers import *
+from logtools.timestamps import *
+from logtools.detect import *
+from logtools.parallel import *
+from logtools.blacklists import *
+from logtools.behavior import *
+from logtools.readers import *
+from logtools.sortkeys import *
+from logtools.utils import ClockCache
 from logtools import logtools_config, interpolate_config, AttrDict
+from logtools._filter import _compile_blacklist_re, _compile_blacklist_func, _required_literal
 
 
 logging.basicConfig(level=logging.INFO)
 
+def parse_cli_args(parse_args, argv):
+    """Parse command-line arguments using given tool's option parser"""
+    orig_argv = sys.argv
+    sys.argv = argv
+    try:
+        return parse_args()
+    finally:
+        sys.argv = orig_argv
+
 
 class ConfigurationTestCase(unittest.TestCase):
     def testInterpolation(self):
@@ -80,6 +107,35 @@ class ParsingTestCase(unittest.TestCase):
             parsed = parser(logrow)
             self.assertNotEquals(parsed, None, "Could not parse line: %s" % str(logrow))
         
+    def testJSONParserProjection(self):
+        parser = JSONParser(fields=['key1', 'nested_key.0.nested_key_1'])
+        parsed = parser(self.json_rows[0])
+        self.assertEquals(parsed['key1'], 'val1')
+        self.assertEquals(parsed['nested_key.0.nested_key_1'], '2')
+        self.assertEquals(len(parsed), 2)
+        self.assertRaises(KeyError, parser, '{"key1": "val1"}')
+        
+        # Flat keys containing dots are looked up as is
+        parser = JSONParser(fields=['http.method', 'user.id'])
+        parsed = parser('{"http.method": "GET", "http": {"method": "POST"}, "user": {"id": 1}}')
+        self.assertEquals(parsed['http.method'], 'GET')
+        self.assertEquals(parsed['user.id'], 1)
+        # Null or scalar values along a path
+        for row in ('{"http.method": "GET", "user": null}', '{"http.method": "GET", "user": 3}',
+                    '{"http.method": "GET", "user": "x"}', '{"http.method": "GET", "user": []}'):
+            self.assertRaises(KeyError, parser, row)
+        columns = parser.parse_many(['{"http.method": "GET", "user": null}', 
+                                     '{"http": {"method": "PUT"}, "user": {"id": 2}}'], 
+                                    fields=['http.method', 'user.id'])
+        self.assertEquals(list(columns['http.method']), ['GET', 'PUT'])
+        self.assertEquals(list(columns['user.id']), [None, 2])
+        
+        parser = JSONParser(decoder='json')
+        for row in ('{"a": 1, "b": 2}', '{"a": 3, "b": 4}', '{"c": 5}'):
+            parsed = parser(row)
+        self.assertEquals(parsed.keys(), ['c'])
+        self.assertEquals(parsed['c'], 5)
+        
     def testAccessLog(self):
         parser = AccessLog()
         parser.set_format(format='%h %l %u %t "%r" %>s %b')
@@ -88,6 +144,48 @@ class ParsingTestCase(unittest.TestCase):
             parsed = parser(logrow)
             self.assertNotEquals(parsed, None, "Could not parse line: %s" % str(logrow))
             
+    def testLogLine(self):
+        data = LogLine(('a', 'b', 'c'))
+        data.wrap(('1', '2', '3'))
+        self.assertEquals(data['b'], '2')
+        self.assertEquals(data.by_index(2), '3')
+        self.assertEquals(data.get('d', 'x'), 'x')
+        self.assertEquals(dict(data.items()), {'a': '1', 'b': '2', 'c': '3'})
+        self.assertTrue('a' in data and 'd' not in data)
+        self.assertRaises(KeyError, data.by_index, 3)
+        
+        # Wrapper is reused for next line
+        data.wrap(('4', '5', '6'))
+        self.assertEquals(data['a'], '4')
+        
+    def testAccessLogProjection(self):
+        parser = AccessLog(format='%h %l %u %t "%r" %>s %b', fields=['%h', '%>s'])
+        self.assertRaises(ValueError, parser, 'example for invalid format')
+        parsed = parser(self.clf_rows[0])
+        self.assertEquals(sorted(parsed.keys()), ['%>s', '%h'])
+        self.assertEquals(parsed['%h'], '127.0.0.1')
+        self.assertEquals(parsed.by_index(5), '200')
+        self.assertRaises(KeyError, parsed.by_index, 2)
+        
+        # Reset projection to parse all fields
+        parser.set_fields(None)
+        self.assertEquals(len(parser(self.clf_rows[0])), 7)
+            
+    def testAccessLogTyped(self):
+        parser = AccessLog(format='%h %l %u %t "%r" %>s %b %D', typed=True)
+        parsed = parser('127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.0" 304 - 1520')
+        self.assertEquals(parsed['%>s'], 304)
+        self.assertEquals(parsed['%b'], 0)
+        self.assertEquals(parsed['%D'], 1520)
+        self.assertEquals(parsed['%t'], 971211336)
+        self.assertEquals(parsed.by_key('%t'), 971211336)
+        self.assertEquals(parsed['%h'], '127.0.0.1')
+        
+        parsed = CommonLogFormat(typed=True)(self.clf_rows[0])
+        self.assertEquals(parsed['%b'], 2326)
+        self.assertRaises(ValueError, parser, 
+                          '127.0.0.1 - - [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.0" - - 1520')
+            
     def testCommonLogFormat(self):
         parser = CommonLogFormat()
         self.assertRaises(ValueError, parser, 'example for invalid format')
@@ -100,13 +198,106 @@ class ParsingTestCase(unittest.TestCase):
         for logrow in self.uwsgi_rows:
             parsed = parser(logrow)
             self.assertNotEquals(parsed, None, "Could not parse line: %s" % logrow)
+            
+        parsed = parser(self.uwsgi_rows[0])
+        self.assertEquals(parsed.items(), [('ip', '24.218.159.119'), ('timestamp', 'Thu Jun 13 22:29:59 2013'),
+                                           ('method', 'GET'), ('path', '/my/uri/path/?param_id=52&token=s61048gkje_l001z'),
+                                           ('bytes', '1813'), ('processing_time', '11')])
+        
+        for method in ('PUT', 'DELETE', 'HEAD', 'OPTIONS', 'PATCH'):
+            parsed = parser(self.uwsgi_rows[1].replace('GET', method))
+            self.assertEquals(parsed['method'], method)
+            
+    def testuWSGIParserInvalid(self):
+        parser = uWSGIParser()
+        for logrow in ['example for invalid format', 
+                       self.uwsgi_rows[0].replace('generated 1813', 'generated many'),
+                       self.uwsgi_rows[0].replace(' msecs ', ' secs '),
+                       self.uwsgi_rows[0].replace('{40 vars in 957 bytes} ', ''),
+                       self.uwsgi_rows[0][:150]]:
+            self.assertRaises(ValueError, parser, logrow)
 
+    def testParseMany(self):
+        try:
+            import numpy
+        except ImportError:
+            print >> sys.stderr, "NumPy Python package not available - skipping parse_many unittest."
+            return
+        
+        columns = CommonLogFormat().parse_many(self.clf_rows + [
+            '127.0.0.3 - - [10/Oct/2000:13:57:01 -0700] "GET / HTTP/1.0" 304 -'])
+        self.assertEquals(list(columns['%>s']), [200, 200, 304])
+        self.assertEquals(list(columns['%b']), [2326, 2326, 0])
+        self.assertEquals(columns['%b'].dtype, numpy.int64)
+        self.assertEquals(columns['%t'][0], numpy.datetime64('2000-10-10T20:55:36'))
+        self.assertEquals(list(columns['%u']), ['frank', 'jay', '-'])
+        
+        columns = uWSGIParser().parse_many(self.uwsgi_rows, fields=['bytes', 'processing_time'])
+        self.assertEquals(sorted(columns.keys()), ['bytes', 'processing_time'])
+        self.assertEquals(list(columns['processing_time']), [11, 9])
+        
+        columns = JSONParser().parse_many(self.json_rows * 2)
+        self.assertEquals(list(columns['key3']), [31337, 31337])
+        self.assertEquals(columns['key1'].dtype, object)
+        columns = JSONParser().parse_many(self.json_rows, fields=['nested_key.0.nested_key_1', 'missing'])
+        self.assertEquals(list(columns['nested_key.0.nested_key_1']), ['2'])
+        self.assertEquals(list(columns['missing']), [None])
+        
+        self.assertRaises(ValueError, CommonLogFormat().parse_many, ['example for invalid format'])
+        
+        columns = CommonLogFormat(typed=True).parse_many(self.clf_rows)
+        self.assertEquals(list(columns['%b']), [2326, 2326])
+        self.assertEquals(columns['%t'][1], numpy.datetime64('2000-10-10T20:56:12'))
+        
+        # Typed and untyped columns are the same
+        rows = ['127.0.0.1 [10/Oct/2000:13:55:36 -0700] 0.5', '127.0.0.1 [10/Oct/2000:13:55:36 +0200] 2']
+        untyped = AccessLog(format='%h %t %T').parse_many(rows)
+        typed = AccessLog(format='%h %t %T', typed=True).parse_many(rows)
+        for field in ('%t', '%T'):
+            self.assertEquals(list(untyped[field]), list(typed[field]))
+            self.assertEquals(untyped[field].dtype, typed[field].dtype)
+        self.assertEquals(list(typed['%T']), [0.5, 2.0])
+        self.assertEquals(typed['%t'][1], numpy.datetime64('2000-10-10T11:55:36'))
+        
+    def testParserRegistry(self):
+        parser = get_parser('AccessLog', format='%h %l %u %t "%r" %>s %b')
+        self.assertEquals(parser(self.clf_rows[0])['%u'], 'frank')
+        # Compiled formats are shared
+        self.assertTrue(parser.fieldselector is AccessLog(format='%h %l %u %t "%r" %>s %b').fieldselector)
+        self.assertTrue(CommonLogFormat().fieldselector is CommonLogFormat().fieldselector)
+        self.assertTrue(isinstance(get_parser('JSONParser', fields=['key1']), JSONParser))
+        self.assertRaises(ValueError, get_parser, 'NoSuchParser')
+        self.assertRaises(ValueError, get_parser, '__import__("os")')
+        
+        class MyParser(CommonLogFormat):
+            pass
+        register_parser(MyParser, 'my_parser')
+        self.assertTrue(isinstance(get_parser('my_parser'), MyParser))
+        
+        # Subclasses compiling formats differently don't share them
+        class UpperParser(AccessLog):
+            def _parse_log_format(self, format, fields=None):
+                fieldselector = AccessLog._parse_log_format(self, format, fields)
+                self.fieldnames = [f.upper() for f in self.fieldnames]
+                self._captured = [f.upper() for f in self._captured]
+                return fieldselector
+        for cls in (UpperParser, AccessLog, UpperParser):
+            parsed = cls(format='%h %u %>s')('127.0.0.1 frank 200')
+            expected = cls is UpperParser and ['%>S', '%H', '%U'] or ['%>s', '%h', '%u']
+            self.assertEquals(sorted(parsed.keys()), expected)
+        
     def testLogParse(self):
         options = AttrDict({'parser': 'CommonLogFormat', 'field': 4, 'header': False})
         fh = StringIO('\n'.join(self.clf_rows))
         output = [l for l in logparse(options, None, fh)]
         self.assertEquals(len(output), len(self.clf_rows), "Output size was not equal to input size!")
         
+    def testLogParseProjection(self):
+        options = AttrDict({'parser': 'CommonLogFormat', 'field': '%h,%u', 'header': False})
+        fh = StringIO('\n'.join(self.clf_rows))
+        output = [l for l in logparse(options, None, fh)]
+        self.assertEquals(output, ['127.0.0.1\tfrank', '127.0.0.2\tjay'])
+        
     def testMultiKeyGetter(self):
         parser = parser = CommonLogFormat()
         func = multikey_getter_gen(parser, keys=(1,2), is_indices=True)
@@ -115,6 +306,91 @@ class ParsingTestCase(unittest.TestCase):
         self.assertEquals(len(output), len(self.clf_rows), "Output size was not equal to input size!")   
         
             
+class TimestampsTestCase(unittest.TestCase):
+    def testFixedLayouts(self):
+        for dateformat, val in [
+            ('%d/%b/%Y:%H:%M:%S', '10/Oct/2000:13:55:36'),
+            ('%d/%b/%Y:%H:%M:%S -0700', '10/Oct/2000:13:55:36 -0700'),
+            ('%Y-%m-%d %H:%M:%S', '2010-01-12 07:00:00'),
+            ('%Y-%m-%dT%H:%M:%S', '2010-01-12T07:00:00'),
+            ('%Y/%m/%d %H:%M:%S', '2010/01/12 07:00:00'),
+            ('%d/%b/%Y:%H:%M:%S', '1/Oct/2000:13:55:36'),
+            ('%b %d %H:%M:%S %Y', 'Jun 13 22:29:59 2013')
+            ]:
+            parse_dt = TimestampParser(dateformat)
+            self.assertEquals(parse_dt(val), datetime.strptime(val, dateformat))
+            # Memoized value
+            self.assertEquals(parse_dt(val), datetime.strptime(val, dateformat))
+            
+    def testInvalidTimestamps(self):
+        parse_dt = TimestampParser('%d/%b/%Y:%H:%M:%S -0700')
+        for val in ('10/Oct/2000:13:55:36 -0800', '10/Foo/2000:13:55:36 -0700', 
+                    '31/Feb/2000:13:55:36 -0700', ''):
+            self.assertRaises(ValueError, parse_dt, val)
+            
+    def testBoundedCache(self):
+        parse_dt = TimestampParser('%Y-%m-%d %H:%M:%S', maxsize=10)
+        for i in range(60):
+            parse_dt('2010-01-12 07:00:%02d' % i)
+        self.assertTrue(len(parse_dt._cache) <= 10)
+        self.assertTrue(get_timestamp_parser('%Y') is get_timestamp_parser('%Y'))
+        
+    def testLogLineDate(self):
+        parsed = CommonLogFormat()('127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.0" 200 2326')
+        self.assertEquals(parsed.by_key('%t'), datetime(2000, 10, 10, 13, 55, 36))
+        
+
+class DetectTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clf_rows = [
+            '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326',
+            '127.0.0.2 - jay [10/Oct/2000:13:56:12 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326'
+            ]
+        self.combined_rows = [l + ' "http://www.example.com/" "Mozilla/4.08"' for l in self.clf_rows]
+        self.json_rows = ['{"key1":"val1","key2":true}', '{"key1":"val2","key2":false}']
+        self.uwsgi_rows = [
+                "[pid: 11216|app: 0|req: 2680/5864] 24.218.159.119 () {40 vars in 957 bytes} [Thu Jun 13 22:29:59 2013] GET /my/uri/path/?param_id=52&token=s61048gkje_l001z => generated 1813 bytes in 11 msecs (HTTP/1.1 200) 2 headers in 73 bytes (1 switches on core 0)"
+        ]
+        fd, self.cache_file = mkstemp()
+        os.close(fd)
+        
+    def tearDown(self):
+        os.remove(self.cache_file)
+        
+    def testDetectParser(self):
+        self.assertEquals(detect_parser(self.clf_rows), ('CommonLogFormat', None))
+        self.assertEquals(detect_parser(self.combined_rows)[0], 'AccessLog')
+        self.assertEquals(detect_parser(self.json_rows), ('JSONParser', None))
+        self.assertEquals(detect_parser(self.uwsgi_rows), ('uWSGIParser', None))
+        # Majority of sample lines decides
+        self.assertEquals(detect_parser(self.json_rows + self.clf_rows[:1]), ('JSONParser', None))
+        self.assertRaises(ValueError, detect_parser, ['foo bar', 'baz'])
+        
+    def testDetectStreamParser(self):
+        fh = StringIO('\n'.join(self.combined_rows))
+        parser, fh = detect_stream_parser(fh, num_lines=1)
+        lines = list(fh)
+        self.assertEquals(len(lines), len(self.combined_rows), "Sampled lines were not replayed")
+        self.assertEquals(parser(lines[1].strip())['%{User-Agent}i'], 'Mozilla/4.08')
+        
+    def testDetectFileParser(self):
+        fd, filename = mkstemp()
+        try:
+            os.write(fd, '\n'.join(self.clf_rows))
+            os.close(fd)
+            with open(filename) as fh:
+                parser, fh = detect_stream_parser(fh, cache_file=self.cache_file)
+                self.assertEquals(len(list(fh)), len(self.clf_rows), "File was not rewound after sampling")
+            self.assertTrue(isinstance(parser, CommonLogFormat))
+            # Cached decision is used
+            with open(self.cache_file) as fh:
+                self.assertTrue('CommonLogFormat' in fh.read())
+            self.assertTrue(isinstance(detect_file_parser(filename, cache_file=self.cache_file), 
+                                       CommonLogFormat))
+        finally:
+            os.remove(filename)
+        
+            
 class FilterBotsTestCase(unittest.TestCase):
     def setUp(self):
         self.options = AttrDict({
@@ -161,6 +437,15 @@ class FilterBotsTestCase(unittest.TestCase):
         for l in filterbots(fh=self.json_fh, **json_options):
             i+=1
         self.assertEquals(i, 1, "filterbots output size different than expected: %s" % str(i))
+        
+        # Field indices
+        self.options['bots_ips'] = StringIO("127.0.0.1\n")
+        self.options['parser'] = 'CommonLogFormat'
+        self.options['ip_ua_fields'] = 'ip:1'
+        lines = ['127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET / HTTP/1.0" 200 2326',
+                 '127.0.0.2 - jay [10/Oct/2000:13:56:12 -0700] "GET / HTTP/1.0" 200 2326']
+        output = list(filterbots(fh=StringIO("\n".join(lines)), **self.options))
+        self.assertEquals(output, lines[1:])
             
     def testRegExpFiltering(self):
         i=0
@@ -169,6 +454,268 @@ class FilterBotsTestCase(unittest.TestCase):
         self.assertEquals(i, 1, "filterbots output size different than expected: %s" % str(i))
 
 
+    def testCIDRFiltering(self):
+        self.options['bots_ips'] = StringIO("6.6.0.0/16\n255.255.255.0/24\n")
+        output = list(filterbots(fh=self.fh, **self.options))
+        self.assertEquals(output, [], "filterbots output size different than expected: %s" % len(output))
+        
+    def testPatternFiltering(self):
+        # Client hammering the site is flagged once it exceeds rate, later requests filtered
+        lines = []
+        for i in range(30):
+            lines.append("7.7.7.7 - USER_AGENT:'Mozilla' - %d - /page/%d" % (1000 + i, i % 3))
+            if i % 10 == 0:
+                lines.append("8.8.8.8 - USER_AGENT:'Mozilla' - %d - /" % (1000 + i))
+        self.options['ip_ua_re'] = "^(?P<ip>.*?) - USER_AGENT:'(?P<ua>.*?)' - (?P<ts>\S+) - (?P<path>.*)"
+        self.options['pattern'] = True
+        self.options['pattern_window'] = 10
+        self.options['pattern_max_requests'] = 5
+        self.options['pattern_blacklist'] = StringIO()
+        # Lines with undecodable timestamps are not analyzed, but not dropped
+        lines.append("9.9.9.9 - USER_AGENT:'Mozilla' - xyz - /")
+        output = list(filterbots(fh=StringIO("\n".join(lines)), **self.options))
+        self.assertEquals(sorted([l.split()[0] for l in output]), 
+                          ['7.7.7.7'] * 5 + ['8.8.8.8'] * 3 + ['9.9.9.9'],
+                          "Unexpected filterbots output: %s" % output)
+        # Flagged clients are added to blacklist
+        self.assertEquals(self.options['pattern_blacklist'].getvalue(), "7.7.7.7\n")
+        
+    def testCompiledBotsUA(self):
+        parsed = parse_bots_ua(self.options.bots_ua)
+        _is_bot_ua = compile_bots_ua(*parsed)
+        for ua in ["Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+                   "Mozilla", "", None, "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; MSIECrawler)",
+                   "MSIECrawler) x", "DotSpotsBot/0.2 (crawler; support at dotspots.com)", "xDotSpotsBot",
+                   "inagist.com url crawler", "Java/1.6.0_18", "Java", "my crawler!"]:
+            self.assertEquals(_is_bot_ua(ua), is_bot_ua(ua, *parsed), "Unexpected result for: %s" % ua)
+            
+        # Many prefixes/suffixes/regular expressions
+        parsed = parse_bots_ua(["p'Bot%d/'" % i for i in range(3000)] + 
+                               ["s'(bot %d)'" % i for i in range(3000)] +
+                               ["r'.*spider(%d)'" % i for i in range(200)] + ["r'(?i)CRAWLER'"])
+        _is_bot_ua = compile_bots_ua(*parsed)
+        for ua in ["Bot42/1.0", "Bot4/", "Bot3000/", "Mozilla (bot 2999)", "Mozilla (bot 3000)",
+                   "a spider42", "a spider", "crawler", "Crawler/1.0", "Mozilla/5.0"]:
+            self.assertEquals(_is_bot_ua(ua), is_bot_ua(ua, *parsed), "Unexpected result for: %s" % ua)
+
+        # Backreferences are not merged
+        parsed = parse_bots_ua(["r'(\\w+)bot/\\1'", "r'(\\w+)spider-\\1'", "r'.*crawler'"])
+        _is_bot_ua = compile_bots_ua(*parsed)
+        for ua in ["xyzspider-xyz", "xyzspider-abc", "abcbot/abc", "abcbot/x", "my crawler"]:
+            self.assertEquals(_is_bot_ua(ua), is_bot_ua(ua, *parsed), "Unexpected result for: %s" % ua)
+        self.assertTrue(_is_bot_ua("xyzspider-xyz"))
+        
+    def testHashedIPsIndex(self):
+        fd, ips_filename = mkstemp()
+        os.write(fd, "# Comment\n6.6.6.6\n")
+        os.close(fd)
+        index_filename = ips_filename + '.idx'
+        try:
+            self.options['bots_ips'] = open(ips_filename)
+            self.options['bots_ips_index'] = index_filename
+            output = list(filterbots(fh=self.fh, **self.options))
+            self.assertEquals(len(output), 1, "filterbots output size different than expected: %s" % len(output))
+            self.assertTrue(is_hashed_set(index_filename))
+            
+            # Index file given as the blacklist
+            self.fh.seek(0)
+            self.options['bots_ua'].seek(0)
+            self.options['bots_ips'] = open(index_filename)
+            self.options['bots_ips_index'] = None
+            output = list(filterbots(fh=self.fh, **self.options))
+            self.assertEquals(len(output), 1, "filterbots output size different than expected: %s" % len(output))
+        finally:
+            os.remove(ips_filename)
+            if os.path.exists(index_filename):
+                os.remove(index_filename)
+                
+                
+class BlacklistsTestCase(unittest.TestCase):
+    def testHashedSet(self):
+        fd, filename = mkstemp()
+        os.close(fd)
+        try:
+            entries = ['10.0.%d.%d' % (i // 256, i % 256) for i in range(5000)]
+            build_hashed_set(entries + entries[:10], filename)
+            hashed_set = HashedSet(filename)
+            self.assertEquals(len(hashed_set), 5000)
+            for entry in entries:
+                self.assertTrue(entry in hashed_set, "Missing entry: %s" % entry)
+            for entry in ['10.1.0.0', '', None, 42, u'10.0.0.1']:
+                self.assertEquals(entry in hashed_set, entry == u'10.0.0.1')
+            hashed_set.close()
+            
+            build_hashed_set([], filename)
+            self.assertFalse('10.0.0.1' in HashedSet(filename))
+            
+            with open(filename, 'wb') as fh:
+                fh.write('10.0.0.1\n')
+            self.assertFalse(is_hashed_set(filename))
+            self.assertRaises(ValueError, HashedSet, filename)
+        finally:
+            os.remove(filename)
+            
+    def testCachedCompile(self):
+        cache_path = mkdtemp()
+        calls = []
+        def build_func(lines):
+            calls.append(lines)
+            return parse_bots_ua(lines)
+        try:
+            lines = ["p'DotSpotsBot'", "r'.*crawler'"]
+            for i in range(2):
+                compiled = cached_compile('bots_ua', lines, build_func, cache_path=cache_path)
+                self.assertTrue(is_bot_ua('DotSpotsBot/0.2', *compiled))
+                self.assertTrue(is_bot_ua('url crawler', *compiled))
+            self.assertEquals(len(calls), 1, "Compiled blacklist was not cached")
+            
+            # Different options / contents are compiled separately
+            cached_compile('bots_ua', lines, build_func, options={'ignorecase': True}, cache_path=cache_path)
+            cached_compile('bots_ua', lines[:1], build_func, cache_path=cache_path)
+            self.assertEquals(len(calls), 3)
+            cached_compile('bots_ua', ['a', 'bc'], build_func, cache_path=cache_path)
+            cached_compile('bots_ua', ['ab', 'c'], build_func, cache_path=cache_path)
+            self.assertEquals(calls[-1], ['ab', 'c'], "Blacklists with same contents share cache entry")
+            
+            # Corrupt cache entries are rebuilt
+            for filename in os.listdir(cache_path):
+                with open(os.path.join(cache_path, filename), 'w') as fh:
+                    fh.write('garbage')
+            compiled = cached_compile('bots_ua', lines, build_func, cache_path=cache_path)
+            self.assertEquals(len(calls), 6)
+            self.assertTrue(is_bot_ua('DotSpotsBot/0.2', *compiled))
+        finally:
+            shutil.rmtree(cache_path)
+
+    def testIPRangeSet(self):
+        ips = IPRangeSet(['6.6.6.6', '10.0.0.0/8', '192.168.1.0/24', '192.168.2.0/24', 
+                          '172.16.5.4/30', '2001:db8::/32', '::1', 'not-an-ip/8'])
+        for ip, expected in [('6.6.6.6', True), ('6.6.6.7', False), ('10.1.2.3', True), 
+                             ('11.0.0.0', False), ('9.255.255.255', False), ('192.168.2.255', True),
+                             ('192.168.3.0', False), ('172.16.5.7', True), ('172.16.5.8', False),
+                             ('2001:db8:1::1', True), ('2001:db9::1', False), ('0:0::1', True),
+                             ('foo', False), ('', False), (None, False)]:
+            self.assertEquals(ip in ips, expected, "Unexpected result for: %s" % ip)
+        # Adjacent ranges are merged
+        self.assertEquals(len(ips), 6)
+        self.assertEquals(parse_cidr('10.1.2.3/8'), (socket.AF_INET, 10 << 24, (11 << 24) - 1))
+        self.assertRaises(ValueError, parse_cidr, '10.0.0.0/33')
+        self.assertRaises(ValueError, parse_cidr, '10.0.0/8')
+            
+    def testWatchedBlacklist(self):
+        fd, filename = mkstemp()
+        os.write(fd, "1.1.1.1\n")
+        os.close(fd)
+        try:
+            blacklist = WatchedBlacklist(open(filename), lambda fh: set(read_blacklist(fh)), interval=0.01)
+            self.assertTrue('1.1.1.1' in blacklist)
+            self.assertFalse('2.2.2.2' in blacklist)
+            
+            # Replace file atomically, as blacklist updaters should
+            with open(filename + '.new', 'w') as fh:
+                fh.write("# Updated\n2.2.2.2\n")
+            os.rename(filename + '.new', filename)
+            for i in range(200):
+                if '2.2.2.2' in blacklist:
+                    break
+                time.sleep(0.01)
+            self.assertTrue('2.2.2.2' in blacklist, "Blacklist was not reloaded")
+            self.assertFalse('1.1.1.1' in blacklist)
+            blacklist.stop()
+            
+            # Failed rebuilds are retried, even if file does not change again
+            failures = []
+            def build_func(fh):
+                entries = set(read_blacklist(fh))
+                if '3.3.3.3' in entries and not failures:
+                    failures.append(1)
+                    raise ValueError("Partially written blacklist")
+                return entries
+            blacklist = WatchedBlacklist(open(filename), build_func, interval=0.01)
+            with open(filename + '.new', 'w') as fh:
+                fh.write("3.3.3.3\n")
+            os.rename(filename + '.new', filename)
+            for i in range(200):
+                if '3.3.3.3' in blacklist:
+                    break
+                time.sleep(0.01)
+            self.assertEquals(failures, [1])
+            self.assertTrue('3.3.3.3' in blacklist, "Failed blacklist reload was not retried")
+            blacklist.stop()
+        finally:
+            os.remove(filename)
+
+class ClockCacheTestCase(unittest.TestCase):
+    def testClockCache(self):
+        calls = []
+        def func(key):
+            calls.append(key)
+            return key * 2
+        cache = ClockCache(func, maxsize=3)
+        for key in [1, 2, 3, 1, 1, 2]:
+            self.assertEquals(cache(key), key * 2)
+        self.assertEquals((cache.hits, cache.misses), (3, 3))
+        
+        # 1, 2 were referenced since insertion, so 3 is evicted
+        self.assertEquals(cache(4), 8)
+        self.assertEquals(len(cache), 3)
+        calls[:] = []
+        for key in [1, 2, 4]:
+            cache(key)
+        self.assertEquals(calls, [], "Referenced entries were evicted")
+        cache(3)
+        self.assertEquals(calls, [3])
+        
+        for key in range(1000):
+            cache(key)
+        self.assertEquals(len(cache), 3)
+        
+        cache.clear()
+        calls[:] = []
+        cache(1)
+        self.assertEquals(calls, [1], "Cache was not cleared")
+        
+
+class BehaviorTestCase(unittest.TestCase):
+    def testRate(self):
+        detector = BehaviorDetector(window=10, max_requests=5)
+        flagged = [detector('a', ts) for ts in [0, 1, 2, 3, 4, 20, 21, 22, 23, 24]]
+        self.assertEquals(flagged, [False] * 10, "Unexpected flagged requests: %s" % flagged)
+        self.assertEquals(detector('a', 25), True, "Client exceeding rate not flagged")
+        self.assertEquals(detector('a', 1000), True, "Flagged client not remembered")
+        self.assertEquals(detector('b', 24), False, "Unrelated client flagged")
+        
+        # Sliding window spans consecutive fixed windows
+        detector = BehaviorDetector(window=10, max_requests=5)
+        flagged = [detector('a', ts) for ts in [0, 9, 9, 9, 9, 10]]
+        self.assertEquals(flagged, [False] * 5 + [True], "Unexpected flagged requests: %s" % flagged)
+        
+    def testDistinctPaths(self):
+        detector = BehaviorDetector(window=60, max_paths=20, min_samples=1000)
+        flagged = [detector('a', i, '/page/%d' % (i % 10)) for i in range(50)]
+        self.assertEquals(True in flagged, False, "Client requesting few paths flagged")
+        flagged = [detector('b', i, '/page/%d' % i) for i in range(50)]
+        self.assertEquals(flagged.index(True) in range(18, 24), True, 
+                          "Unexpected flagged requests: %s" % flagged)
+        
+    def testRegularity(self):
+        detector = BehaviorDetector(min_samples=20)
+        flagged = [detector('a', 30 * i) for i in range(30)]
+        self.assertEquals(flagged.index(True), 20, "Unexpected flagged requests: %s" % flagged)
+        ts = 0
+        for i in range(100):
+            ts += (i * 7919) % 37 + 1
+            self.assertEquals(detector('b', ts), False, "Irregular client flagged")
+            
+    def testBoundedState(self):
+        detector = BehaviorDetector(window=10, max_requests=2, max_clients=100)
+        for i in range(1000):
+            for ts in range(3):
+                detector(i, ts)
+        self.assertEquals(len(detector._clients), 100)
+        self.assertEquals(len(detector.flagged), 100)
+        
+
 class GeoIPTestCase(unittest.TestCase):
     def setUp(self):
         self.options = AttrDict({ 'ip_re': '^(.*?) -' })
@@ -300,6 +847,132 @@ class FilterTestCase(unittest.TestCase):
         self.assertEquals(lines, self.exp_emitted_wb, "Number of lines emitted was not as expected: %s (Expected: %s)" %
                           (lines, self.exp_emitted_wb))          
 
+    def testREIgnoreCase(self):
+        """Regular Expression-based matching, ignoring case"""
+        lines = [l for l in logfilter(self.testset, blacklist=self.blacklist, field=1, delimiter="\t", 
+                                      with_acora=False, ignorecase=True, word_boundaries=True)]
+        self.assertEquals(lines, ["wordAA", "AAword", "wordAAword"])
+        
+    def testCompileBlacklist(self):
+        """Blacklist compiled into a single alternation"""
+        blacklist = ['word%d' % i for i in range(5000)] + ['fo+', 'b(a)r']
+        regexes = _compile_blacklist_re(blacklist, word_boundaries=True)
+        self.assertEquals(len(regexes), 1)
+        for val, expected in [('word4999', True), ('a word42 b', True), ('word5000', False),
+                              ('fooo', True), ('bar', True), ('baz', False), ('word', False)]:
+            self.assertEquals(bool(regexes[0].search(val)), expected, "Unexpected match for: %s" % val)
+        # Too many groups for a single expression
+        regexes = _compile_blacklist_re(['(a%d)' % i for i in range(200)])
+        self.assertEquals(len(regexes), 200)
+        self.assertTrue(regexes[42].search('xa42'))
+        self.assertEquals(_compile_blacklist_re([]), [])
+
+    def testCompileBlacklistWordBoundaries(self):
+        """Word boundaries apply to each entry as a whole"""
+        for blacklist in (['foo|bar'], ['foo|bar', 'baz'], ['foo|bar', '(x)\\1']):
+            is_blacklisted = _compile_blacklist_func(blacklist, field=1, word_boundaries=True)
+            for val, expected in [('foo', True), ('a-bar', True), ('xbar', False), ('foox', False),
+                                  ('barx', False), ('xfoo', False)]:
+                self.assertEquals(is_blacklisted(val), expected, 
+                                  "Unexpected match for: %s (blacklist: %s)" % (val, blacklist))
+        
+    def testCompileBlacklistSeparate(self):
+        """Entries with backreferences or inline flags are not merged"""
+        is_blacklisted = _compile_blacklist_func(['(x|y)\\1', '(c|d)\\1'], field=1)
+        for val, expected in [('xx', True), ('cc', True), ('xy', False), ('cd', False)]:
+            self.assertEquals(is_blacklisted(val), expected, "Unexpected match for: %s" % val)
+        is_blacklisted = _compile_blacklist_func(['(?i)(a|b)', '(c|d)', 'foo', 'ba?r'], field=1)
+        for val, expected in [('A', True), ('c', True), ('C', False), ('FOO', False), ('bar', True)]:
+            self.assertEquals(is_blacklisted(val), expected, "Unexpected match for: %s" % val)
+        self.assertEquals(len(_compile_blacklist_re(['(x|y)\\1', '(?i)a', 'fo+', 'bar'])), 3)
+
+    def testParallel(self):
+        """Filtering regular files using multiple worker processes"""
+        fd, filename = mkstemp()
+        try:
+            os.write(fd, self.testset.getvalue() * 50)
+            os.close(fd)
+            for with_acora in (False, True):
+                expected = list(logfilter(open(filename), blacklist=StringIO(self.blacklist.getvalue()), 
+                                          field=1, delimiter="\t", with_acora=with_acora, 
+                                          word_boundaries=True))
+                lines = list(logfilter(open(filename), blacklist=StringIO(self.blacklist.getvalue()), 
+                                       field=1, delimiter="\t", with_acora=with_acora, 
+                                       word_boundaries=True, jobs=3))
+                self.assertEquals(lines, expected, "Parallel output differs from serial output")
+                self.assertEquals(len(lines), self.exp_emitted_wb * 50)
+            # Counters are aggregated across workers
+            counts = {}
+            lines = list(parallel_filter_lines(open(filename), lambda l: l.startswith('AA'), 
+                                               counts=counts, jobs=2))
+            self.assertEquals(counts, {'lines': 300, 'filtered': 150, 'nomatch': 0})
+        finally:
+            os.remove(filename)
+            
+    def testRequiredLiteral(self):
+        """Required literal extraction for regex prefiltering"""
+        for pattern, literal in [('foo(bar)baz\\d+qux', 'foobarbaz'), ('a(b|c)def', 'def'),
+                                 ('ab?c', 'a'), ('foo|bar', None), ('\\d+', None), ('(?i)FOO', None)]:
+            self.assertEquals(_required_literal(pattern), literal, "Unexpected literal for: %s" % pattern)
+        self.assertEquals(_required_literal('(?i)FOO', re.IGNORECASE), 'foo')
+        
+    def testREPrefilter(self):
+        """Regular Expression-based matching, prefiltered on literals"""
+        blacklist = StringIO("\n".join(['user\\d+@example', 'AA', '^\\d+$', 'a(b|c)d'])+"\n")
+        testset = StringIO("\n".join(['user42@example', 'user@example', 'xAAx', 
+                                       '1234', '12a', 'abd', 'ad'])+"\n")
+        lines = [l for l in logfilter(testset, blacklist=blacklist, field=1, delimiter="\t", 
+                                      with_acora=False, ignorecase=True, word_boundaries=False)]
+        self.assertEquals(lines, ['user@example', '12a', 'ad'])
+
+
+class FilterCLITestCase(unittest.TestCase):
+    """Parser-based field matching via the logfilter/logtail command-line options"""
+    def setUp(self):
+        self.clf_rows = [
+            '127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326',
+            '127.0.0.2 - jay [10/Oct/2000:13:56:12 -0700] "GET /apache_pb.gif HTTP/1.0" 200 2326',
+            '127.0.0.3 - bob [11/Oct/2000:10:00:00 -0700] "GET /index.html HTTP/1.0" 200 100'
+            ]
+        self.tmp_dir = mkdtemp()
+        self.log_filename = os.path.join(self.tmp_dir, 'access_log')
+        with open(self.log_filename, 'w') as fh:
+            fh.write('\n'.join(self.clf_rows) + '\n')
+        self.blacklist_filename = os.path.join(self.tmp_dir, 'blacklist')
+        with open(self.blacklist_filename, 'w') as fh:
+            fh.write('frank\n127.0.0.3\n')
+            
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        
+    def _logfilter(self, *argv):
+        options, args = parse_cli_args(logfilter_parse_args, 
+            ['logfilter', '-b', self.blacklist_filename] + list(argv) + [self.log_filename])
+        try:
+            return list(logfilter(fh=open_inputs(args), **options))
+        finally:
+            options.blacklist.close()
+        
+    def testLogFilter(self):
+        self.assertEquals(self._logfilter('--parser', 'CommonLogFormat', '-f', '%u'), 
+                          self.clf_rows[1:])
+        self.assertEquals(self._logfilter('--parser', 'CommonLogFormat', '-f', '%u,%h'), 
+                          self.clf_rows[1:2])
+        self.assertEquals(self._logfilter('--parser', 'CommonLogFormat', '-f', '1'), 
+                          self.clf_rows[:2])
+        self.assertEquals(self._logfilter('--parser', 'auto', '-f', '%u', '--reverse'), 
+                          self.clf_rows[:1])
+        self.assertEquals(self._logfilter('-d', ' ', '-f', '3'), self.clf_rows[1:])
+        
+    def testLogTail(self):
+        for field in ('%t', '4'):
+            options, args = parse_cli_args(logtail_parse_args, 
+                ['logtail', '--parser', 'CommonLogFormat', '-f', field, 
+                 '--date-format', '%d/%b/%Y:%H:%M:%S', '--start-date', '2000-10-10 13:56:00',
+                 self.log_filename])
+            self.assertEquals(list(logtail(fh=open_inputs(args), **options)), self.clf_rows[1:],
+                              "Unexpected logtail output for field: %s" % field)
+        
 
 class MergeTestCase(unittest.TestCase):
     def setUp(self):
@@ -356,7 +1029,260 @@ class MergeTestCase(unittest.TestCase):
         self.assertEquals(map(itemgetter(0), output), sorted(map(itemgetter(0), output)), 
                           "Output was not lexically sorted!")
         
+    def testParserMerge(self):
+        for i, fh in enumerate([self.tempfiles[0][0], self.tempfiles[1][0]]):
+            os.write(fh, "\n".join(['127.0.0.%d - - [10/Oct/2000:13:55:%02d -0700] "GET / HTTP/1.0" 200 %d' % 
+                                    (i, s, s) for s in range(i, 60, 2)]) + "\n")
+        for prefetch in (0, 1, 4):
+            options = AttrDict({'field': '%b', 'numeric': True, 'parser': 'CommonLogFormat', 
+                                'bench': True, 'prefetch': prefetch})
+            output = [(k, l) for k, l in logmerge(options, self.args)]
+            self.assertEquals(map(itemgetter(0), output), range(60), "Output was not numerically sorted!")
+            self.assertEquals(output[1][1].startswith('127.0.0.1 '), True, "Unexpected line: %s" % output[1][1])
+        
+    def testKeyFunc(self):
+        line = "a  b\tc 5"
+        self.assertEquals(make_key_func(2)(line), ('', line))
+        self.assertEquals(make_key_func(3, delimiter=None)(line), ('c', line))
+        self.assertEquals(make_key_func(4, delimiter=None, numeric=True)(line), (5, line))
+        key_func = make_key_func(1, delimiter=',', datetime=True, dateformat='%Y/%m/%d %H:%M:%S')
+        self.assertEquals(key_func('2010/01/12 07:00:00,one'), 
+                          (datetime(2010, 1, 12, 7, 0, 0), '2010/01/12 07:00:00,one'))
+        
+        
+class ReadersTestCase(unittest.TestCase):
+    def testLineBatches(self):
+        lines = [" line %d " % i for i in range(1000)]
+        fd, filename = mkstemp()
+        try:
+            os.write(fd, "\n".join(lines))
+            os.close(fd)
+            for data in ["\n".join(lines), "\n".join(lines) + "\n"]:
+                with open(filename, 'wb') as fh:
+                    fh.write(data)
+                for fh in [open(filename, 'rb'), StringIO(data)]:
+                    batches = list(line_batches(fh, read_size=100))
+                    self.assertEquals(len(batches) > 1, True, "Expected multiple batches")
+                    self.assertEquals(sum(batches, []), [line.strip() for line in lines])
+                    
+            # Empty file, reading from current position
+            with open(filename, 'wb') as fh:
+                pass
+            self.assertEquals(list(line_batches(open(filename, 'rb'))), [])
+            with open(filename, 'wb') as fh:
+                fh.write("skipped\nfirst\nsecond\n")
+            fh = open(filename, 'rb')
+            fh.readline()
+            self.assertEquals(list(line_batches(fh)), [['first', 'second']])
+        finally:
+            os.remove(filename)
+            
+    def testPrefetch(self):
+        self.assertEquals(list(prefetch(iter(range(100)), size=3)), range(100))
+        self.assertEquals(list(prefetch([])), [])
+        
+        def failing():
+            yield 1
+            raise ValueError("Read error")
+        self.assertRaises(ValueError, list, prefetch(failing()))
+        
+        # Consumer stopping early does not leave producer blocked
+        items = prefetch(iter(range(100)), size=1)
+        self.assertEquals(items.next(), 0)
+        items.close()
+        
+    def testTimedBatches(self):
+        self.assertEquals(list(timed_batches(range(7), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEquals(list(timed_batches(range(7), 3, max_latency=10)), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEquals(list(timed_batches([], 3, max_latency=10)), [])
+        
+        def slow():
+            yield 1
+            yield 2
+            time.sleep(0.5)
+            yield 3
+        start = time.time()
+        batches = timed_batches(slow(), 10, max_latency=0.1)
+        self.assertEquals(batches.next(), [1, 2])
+        self.assertEquals(time.time() - start < 0.4, True, "Batch was not emitted after max latency")
+        self.assertEquals(list(batches), [[3]])
+        
+        def failing():
+            yield 1
+            raise ValueError("Read error")
+        self.assertRaises(ValueError, list, timed_batches(failing(), 10, max_latency=0.1))
+        
+    def testCompressedInput(self):
+        lines = ["line %d" % i for i in range(10000)]
+        data = "\n".join(lines) + "\n"
+        fd, filename = mkstemp()
+        os.close(fd)
+        fd, plain_filename = mkstemp()
+        os.write(fd, "plain\n")
+        os.close(fd)
+        try:
+            # Multi-member gzip, concatenated bz2 streams
+            gz = StringIO()
+            for i in range(2):
+                gz_fh = gzip.GzipFile(fileobj=gz, mode='wb')
+                gz_fh.write(data)
+                gz_fh.close()
+            for compressed, compression in [(gz.getvalue(), 'gzip'), 
+                                            (bz2.compress(data) * 2, 'bz2')]:
+                self.assertEquals(detect_compression(compressed), compression)
+                with open(filename, 'wb') as fh:
+                    fh.write(compressed)
+                for source in [filename, open(filename, 'rb'), StringIO(compressed)]:
+                    fh = open_input(source, read_ahead=1)
+                    self.assertEquals(list(fh), [l + "\n" for l in lines] * 2, 
+                                      "Unexpected %s decompressed lines" % compression)
+                self.assertEquals(open_input(filename).read(), data * 2)
+                fh = open_input(filename)
+                self.assertEquals(fh.readline(), "line 0\n")
+                self.assertEquals(sum(line_batches(fh), []), lines[1:] + lines)
+                
+                output = list(open_inputs([filename, plain_filename]))
+                self.assertEquals(len(output), 20001)
+                self.assertEquals(output[-1], "plain\n")
+                
+                with open(filename, 'wb') as fh:
+                    fh.write(compressed[:100] + "garbage" * 100)
+                self.assertRaises(IOError, list, open_input(filename))
+                
+            self.assertEquals(detect_compression(data), None)
+            self.assertEquals(type(open_input(plain_filename)), file, 
+                              "Uncompressed regular file was not returned as is")
+        finally:
+            os.remove(filename)
+            os.remove(plain_filename)
+            
+    def testInputReaderClose(self):
+        """Reader thread stops when consumer stops early and closes input"""
+        data = "line\n" * 1000000
+        for source in (StringIO(data), StringIO(bz2.compress(data))):
+            reader = open_input(source, read_ahead=1)
+            self.assertEquals(reader.readline(), "line\n")
+            time.sleep(0.1)
+            reader.close()
+            reader._thread.join(5)
+            self.assertFalse(reader._thread.is_alive(), "Reader thread still running after close")
    
+
+class SortTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.lines = ["%d line%d" % (random.randint(-1000, 1000), i) for i in range(1000)]
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        
+    def testSort(self):
+        output = list(logsort(StringIO("\n".join(self.lines)), field=1, numeric=True))
+        self.assertEquals(output, sorted([(int(l.split()[0]), l) for l in self.lines]), 
+                          "Output was not numerically sorted!")
+        self.assertEquals(list(logsort(StringIO(""), field=1)), [])
+        
+    def testExternalSort(self):
+        expected = sorted([(l.split()[1], l) for l in self.lines])
+        for jobs in (1, 2):
+            output = list(logsort(StringIO("\n".join(self.lines) + "\n"), field=2, 
+                                  chunk_size=300, tmp_dir=self.tmp_dir, jobs=jobs))
+            self.assertEquals(output, expected, "Output was not lexically sorted!")
+            self.assertEquals(os.listdir(self.tmp_dir), [], "Sorted runs were not removed")
+            
+    def testRunsKeyedOnce(self):
+        """Lines are not keyed again when merging sorted runs"""
+        import logtools._sort
+        calls = []
+        make_key_func = logtools._sort.make_key_func
+        def counting_make_key_func(*args, **kwargs):
+            key_func = make_key_func(*args, **kwargs)
+            def _key_func(line):
+                calls.append(line)
+                return key_func(line)
+            return _key_func
+        logtools._sort.make_key_func = counting_make_key_func
+        try:
+            output = list(logsort(StringIO("\n".join(self.lines)), field=1, numeric=True, 
+                                  chunk_size=300, tmp_dir=self.tmp_dir))
+        finally:
+            logtools._sort.make_key_func = make_key_func
+        self.assertEquals(output, sorted([(int(l.split()[0]), l) for l in self.lines]))
+        self.assertEquals(len(calls), len(self.lines))
+        
+    def testSortCleanup(self):
+        """Sorted runs are removed when sorting fails or is stopped early"""
+        output = logsort(StringIO("\n".join(self.lines)), field=2, chunk_size=300, tmp_dir=self.tmp_dir)
+        output.next()
+        self.assertEquals(len(os.listdir(self.tmp_dir)), 4)
+        output.close()
+        self.assertEquals(os.listdir(self.tmp_dir), [], "Sorted runs were not removed")
+        
+        lines = self.lines[:500] + ["invalid line"] + self.lines[500:]
+        output = logsort(StringIO("\n".join(lines)), field=1, numeric=True, chunk_size=300, 
+                         tmp_dir=self.tmp_dir)
+        self.assertRaises(ValueError, list, output)
+        self.assertEquals(os.listdir(self.tmp_dir), [], "Sorted runs were not removed")
+        
+    def testDateSort(self):
+        lines = ['127.0.0.1 - - [10/Oct/2000:13:%02d:00 -0700] "GET / HTTP/1.0" 200 %d' % (m, m) 
+                 for m in range(60)]
+        random.shuffle(lines)
+        output = list(logsort(StringIO("\n".join(lines)), field='%t', parser='CommonLogFormat', 
+                              datetime=True, dateformat='[%d/%b/%Y:%H:%M:%S -0700]', chunk_size=7))
+        self.assertEquals([int(l.split()[-1]) for k, l in output], range(60), 
+                          "Output was not time sorted!")
+        
+
+class JoinTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.db_filename = mkstemp()
+        os.close(fd)
+        conn = sqlite3.connect(self.db_filename)
+        conn.execute("CREATE TABLE users (id INTEGER, name TEXT)")
+        conn.executemany("INSERT INTO users VALUES (?, ?)", 
+                         [(i, "user%d" % i) for i in range(100)] + [(7, "seven")])
+        conn.commit()
+        conn.close()
+        self.options = AttrDict({
+            'field': 2, 'delimiter': ' ', 'backend': 'sqlalchemy',
+            'join_connect_string': 'sqlite:///' + self.db_filename,
+            'join_remote_fields': 'name', 'join_remote_name': 'users', 'join_remote_key': 'id'
+        })
+        self.rows = ["row%d %d" % (i, (i * 7) % 150) for i in range(200)]
+        
+    def tearDown(self):
+        os.remove(self.db_filename)
+        
+    def testJoin(self):
+        self.options['batch_size'] = 1
+        expected = list(logjoin(StringIO("\n".join(self.rows)), **self.options))
+        self.assertEquals(len(expected), 
+                          len([r for r in self.rows if int(r.split()[1]) < 100]) + 
+                          len([r for r in self.rows if r.endswith(' 7')]))
+        self.assertEquals(expected[1], (u'7', u'row1 7 user7'))
+        
+        for batch_size, max_latency in [(3, None), (50, None), (1000, 0.5)]:
+            self.options['batch_size'] = batch_size
+            self.options['max_latency'] = max_latency
+            output = list(logjoin(StringIO("\n".join(self.rows)), **self.options))
+            self.assertEquals([key for key, row in output], [key for key, row in expected],
+                              "Batched join output not in input order")
+            self.assertEquals(sorted(output), sorted(expected))
+            
+    def testJoinAffinity(self):
+        """Keys matched by the database through type conversion
+        are joined the same in batched and row-by-row modes"""
+        rows = ["r1 007", "r2 7", "r3 7.0", "r4 x7", "r5 42"]
+        self.options['batch_size'] = 1
+        expected = list(logjoin(StringIO("\n".join(rows)), **self.options))
+        self.assertEquals([key for key, row in expected], 
+                          [u'007', u'007', u'7', u'7', u'7.0', u'7.0', u'42'])
+        for batch_size in (2, 500):
+            self.options['batch_size'] = batch_size
+            self.assertEquals(list(logjoin(StringIO("\n".join(rows)), **self.options)), expected)
+        
+
 class QPSTestCase(unittest.TestCase):
     def setUp(self):
         self.options = AttrDict({
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+logtools.timestamps
+Fast decoding of log timestamps. Fixed-layout parsers are used
+for the common Apache CLF / ISO-8601 style formats, falling back
+to datetime.strptime() otherwise. Decoded values are memoized per
+distinct timestamp string, so consecutive lines logged within the
+same second are only decoded once.
+"""
+from calendar import timegm
+from datetime import datetime
+
+__all__ = ['CLF_DATE_FORMAT', 'parse_clf_timestamp', 'parse_iso_timestamp',
+           'TimestampParser', 'get_timestamp_parser', 'clf_epoch']
+
+# Apache %t timestamp, without the brackets and timezone
+CLF_DATE_FORMAT = '%d/%b/%Y:%H:%M:%S'
+
+_MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+}
+
+
+def parse_clf_timestamp(s):
+    """Parse a fixed-layout CLF timestamp, e.g '10/Oct/2000:13:55:36'"""
+    if len(s) != 20 or s[2] != '/' or s[6] != '/' or \
+       s[11] != ':' or s[14] != ':' or s[17] != ':':
+        raise ValueError("Invalid CLF timestamp: '%s'" % s)
+    return datetime(int(s[7:11]), _MONTHS[s[3:6]], int(s[:2]),
+                    int(s[12:14]), int(s[15:17]), int(s[18:20]))
+
+
+def parse_iso_timestamp(s, date_sep='-', sep=' '):
+    """Parse a fixed-layout ISO-8601 style timestamp,
+    e.g '2000-10-10 13:55:36' (or '2000-10-10T13:55:36' with sep='T')"""
+    if len(s) != 19 or s[4] != date_sep or s[7] != date_sep or \
+       s[10] != sep or s[13] != ':' or s[16] != ':':
+        raise ValueError("Invalid ISO timestamp: '%s'" % s)
+    return datetime(int(s[:4]), int(s[5:7]), int(s[8:10]),
+                    int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+
+# Date formats for which a fixed-layout parser is available.
+# Values are (parser function, length of timestamp string)
+_FIXED_LAYOUTS = {
+    CLF_DATE_FORMAT:     (parse_clf_timestamp, 20),
+    '%Y-%m-%d %H:%M:%S': (parse_iso_timestamp, 19),
+    '%Y-%m-%dT%H:%M:%S': (lambda s: parse_iso_timestamp(s, sep='T'), 19),
+    '%Y/%m/%d %H:%M:%S': (lambda s: parse_iso_timestamp(s, date_sep='/'), 19),
+}
+
+
+class TimestampParser(object):
+    """Callable decoding timestamp strings of a given (strptime) format
+    into datetime objects. Uses a fixed-layout parser when the format
+    is one of the known layouts (optionally followed by literal text,
+    e.g '%d/%b/%Y:%H:%M:%S -0700'), and keeps a bounded memo cache
+    of the decoded values"""
+
+    def __init__(self, dateformat, maxsize=4096):
+        self.dateformat = dateformat
+        self.maxsize = maxsize
+        self._cache = {}
+        self._fast_parse = None
+        self._layout_len = None
+        self._suffix = None
+
+        for layout, (func, layout_len) in _FIXED_LAYOUTS.iteritems():
+            suffix = dateformat[len(layout):]
+            if dateformat.startswith(layout) and '%' not in suffix:
+                self._fast_parse = func
+                self._layout_len = layout_len
+                self._suffix = suffix
+                break
+
+    def __call__(self, s):
+        try:
+            return self._cache[s]
+        except KeyError:
+            dt = self._parse(s)
+            cache = self._cache
+            if len(cache) >= self.maxsize:
+                cache.clear()
+            cache[s] = dt
+            return dt
+
+    def _parse(self, s):
+        """Decode timestamp, using fixed-layout parser if available.
+        Falls back to strptime on unexpected input, so that any errors
+        raised are the same as when using strptime directly"""
+        if self._fast_parse is not None:
+            try:
+                if s[self._layout_len:] == self._suffix:
+                    return self._fast_parse(s[:self._layout_len])
+            except (ValueError, KeyError, IndexError, TypeError):
+                pass
+        return datetime.strptime(s, self.dateformat)
+
+
+_timestamp_parsers = {}
+
+def get_timestamp_parser(dateformat):
+    """Return a shared TimestampParser instance for given date format"""
+    try:
+        return _timestamp_parsers[dateformat]
+    except KeyError:
+        parser = _timestamp_parsers[dateformat] = TimestampParser(dateformat)
+        return parser
+
+
+_clf_epoch_cache = {}
+
+def clf_epoch(value, maxsize=4096):
+    """Decode an Apache %t value, e.g '[10/Oct/2000:13:55:36 -0700]',
+    into (UTC) epoch seconds, applying its timezone offset.
+    Decoded values are memoized"""
+    try:
+        return _clf_epoch_cache[value]
+    except KeyError:
+        if len(value) != 28 or value[0] != '[' or value[-1] != ']' or \
+           value[22] not in '+-':
+            raise ValueError("Invalid CLF timestamp: '%s'" % value)
+        offset = int(value[23:25]) * 3600 + int(value[25:27]) * 60
+        if value[22] == '-':
+            offset = -offset
+        epoch = timegm(get_timestamp_parser(CLF_DATE_FORMAT)(value[1:21]).timetuple()) - offset
+        if len(_clf_epoch_cache) >= maxsize:
+            _clf_epoch_cache.clear()
+        _clf_epoch_cache[value] = epoch
+        return epoch
@@ -19,8 +19,11 @@ but can be used by other methods
 """
 
 import os
+import re
 import sys
 import time
+import sre_parse
+import sre_constants
 	
 def tail_f(fname, block=True, sleep=1):
 	"""Mimic tail -f functionality on file descriptor.
@@ -43,3 +46,162 @@ def tail_f(fname, block=True, sleep=1):
 			fh.seek(where)
 		else:
 			yield line
+
+
+def cache_dir():
+	"""Return path of the logtools cache directory,
+	($XDG_CACHE_HOME/logtools or ~/.cache/logtools),
+	creating it if it does not exist yet"""
+	path = os.path.join(os.environ.get('XDG_CACHE_HOME') or \
+				os.path.expanduser('~/.cache'), 'logtools')
+	if not os.path.isdir(path):
+		try:
+			os.makedirs(path)
+		except OSError:
+			# Created concurrently
+			if not os.path.isdir(path):
+				raise
+	return path
+
+def trie_regex(words):
+	"""Return a regular expression pattern string matching any
+	of the given literal strings. Words are factored into a trie,
+	so that shared prefixes are only matched once, e.g
+	['foo', 'foobar', 'fob'] yields 'fo(?:o(?:bar)?|b)'"""
+	trie = {}
+	for word in words:
+		node = trie
+		for char in word:
+			node = node.setdefault(char, {})
+		node[''] = None
+	return _trie_pattern(trie)
+
+def _trie_pattern(node):
+	"""Build regex pattern for trie node (see trie_regex)"""
+	terminal = '' in node
+	alts = []
+	chars = []
+	for char in sorted(node):
+		if char == '':
+			continue
+		child = node[char]
+		if child.keys() == ['']:
+			# Leaf, can be folded into a character class
+			chars.append(re.escape(char))
+			continue
+		# Follow non-branching chains iteratively, so that
+		# recursion depth is bounded by the number of branches
+		prefix = [re.escape(char)]
+		while len(child) == 1 and '' not in child:
+			char, child = child.items()[0]
+			prefix.append(re.escape(char))
+		alts.append(''.join(prefix) + _trie_pattern(child))
+
+	if chars:
+		if len(chars) == 1:
+			alts.append(chars[0])
+		else:
+			alts.append('[' + ''.join(chars) + ']')
+
+	if not alts:
+		return ''
+	if len(alts) == 1 and not chars:
+		pattern = alts[0]
+		if terminal:
+			pattern = '(?:' + pattern + ')?'
+		return pattern
+	if len(alts) == 1:
+		# Single character (class)
+		return alts[0] + (terminal and '?' or '')
+	return '(?:' + '|'.join(alts) + ')' + (terminal and '?' or '')
+
+def is_mergeable_pattern(pattern, flags=0):
+	"""Check whether regular expression pattern can be merged into an
+	alternation with other patterns without changing what it matches.
+	Patterns containing group references (backreferences, conditional
+	groups) can't, as merging renumbers their groups, nor can patterns
+	setting inline flags (e.g (?i)), which apply to the whole expression"""
+	try:
+		parsed = sre_parse.parse(pattern, flags)
+	except (sre_constants.error, OverflowError, RuntimeError):
+		# Left for the merged expression to fail compiling
+		return True
+	if parsed.pattern.flags & ~flags:
+		return False
+	return not _has_group_refs(parsed)
+
+def _has_group_refs(subpattern):
+	"""Check whether parsed regular expression (sequence)
+	contains group references (see is_mergeable_pattern)"""
+	for op, av in subpattern:
+		if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+			return True
+		if _av_has_group_refs(av):
+			return True
+	return False
+
+def _av_has_group_refs(av):
+	if isinstance(av, sre_parse.SubPattern):
+		return _has_group_refs(av)
+	if isinstance(av, (list, tuple)):
+		for item in av:
+			if _av_has_group_refs(item):
+				return True
+	return False
+
+class ClockCache(object):
+	"""Bounded memoizing wrapper for a single-argument function,
+	using the CLOCK (second chance) eviction policy: a ring of 
+	cache slots with a 'referenced' bit, which is set on hits and
+	cleared by the clock hand looking for a slot to evict. Keeps 
+	hit/miss counters. Cached values can be dropped using clear()"""
+
+	def __init__(self, func, maxsize=10000):
+		self.func = func
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self.clear()
+
+	def clear(self):
+		"""Drop all cached values. Cache state is swapped in 
+		a single assignment, so this is safe to call from another
+		thread (e.g when the wrapped function's data is reloaded)"""
+		# key -> slot index, slot keys, slot values, referenced bits, hand
+		self._state = ({}, [], [], [], [0])
+
+	def __call__(self, key):
+		index, keys, values, refs, hand = self._state
+		try:
+			slot = index[key]
+		except KeyError:
+			pass
+		else:
+			self.hits += 1
+			refs[slot] = True
+			return values[slot]
+
+		self.misses += 1
+		value = self.func(key)
+		if len(keys) < self.maxsize:
+			index[key] = len(keys)
+			keys.append(key)
+			values.append(value)
+			refs.append(False)
+			return value
+
+		# Advance hand to first slot not referenced
+		# since last visited, giving it a second chance
+		slot = hand[0]
+		while refs[slot]:
+			refs[slot] = False
+			slot = (slot + 1) % self.maxsize
+		del index[keys[slot]]
+		index[key] = slot
+		keys[slot] = key
+		values[slot] = value
+		hand[0] = (slot + 1) % self.maxsize
+		return value
+
+	def __len__(self):
+		return len(self._state[1])
@@ -27,7 +27,7 @@ setup(
     author_email = 'adamhadani@gmail.com',
     url          = 'http://github.com/adamhadani/logtools',
     keywords     = ['logging', 'sampling', 'geoip', 'filterbots', 'aggregate',
-                    'logparse', 'logmerge', 'logjoin', 'urlparse', 'logplot', 'qps', 'filter'],
+                    'logparse', 'logmerge', 'logsort', 'logjoin', 'urlparse', 'logplot', 'qps', 'filter'],
     classifiers = [
         "Programming Language :: Python",
         "Programming Language :: Python :: 2.6",
@@ -81,6 +81,7 @@ This software is distributed under the Apache 2.0 license.
             'logjoin = logtools:logjoin_main',
             'logplot = logtools:logplot_main',
             'logsample = logtools:logsample_main',
+            'logsort = logtools:logsort_main',
             'logfilter = logtools:logfilter_main',
             'logtail = logtools:logtail_main',
             'qps = logtools:qps_main',